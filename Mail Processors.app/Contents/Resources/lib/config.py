@@ -7,11 +7,12 @@ Busca config en orden:
 2. {APP_PATH}/Contents/Resources/config/config.toml (dentro de la app)
 """
 
-import os
 import sys
-import tomllib
+import tempfile
 from pathlib import Path
 
+from config_cache import load_config
+
 # =============================================================================
 # Detectar ubicación de la app
 # =============================================================================
@@ -65,8 +66,7 @@ def find_config() -> Path:
 CONFIG_FILE = find_config()
 
 # Cargar configuración
-with open(CONFIG_FILE, "rb") as f:
-    _config = tomllib.load(f)
+_config = load_config(CONFIG_FILE)
 
 # =============================================================================
 # Exportar valores de configuración
@@ -87,8 +87,10 @@ if not GEMINI_API_KEY or GEMINI_API_KEY.startswith("YOUR_"):
 _paths = _config.get("paths", {})
 OUTPUT_FOLDER = Path(_paths.get("output_folder", "~/Documents")).expanduser()
 PYTHON_PATH = _paths.get("python_path", "/usr/bin/python3")
-QPDF_PATH = _paths.get("qpdf_path", "/opt/homebrew/bin/qpdf")
-EML_TEMP_FOLDER = Path(_paths.get("eml_temp_folder", "~/Library/MailEML")).expanduser()
+# Vacío en config.toml: usar el directorio temporal del sistema (no el cwd)
+EML_TEMP_FOLDER = Path(
+    _paths.get("eml_temp_folder", "~/Library/MailEML") or Path(tempfile.gettempdir()) / "apple_mail_eml"
+).expanduser()
 
 # Mail
 _mail = _config.get("mail", {})
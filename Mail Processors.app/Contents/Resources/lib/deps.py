@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Verificación de dependencias Python de los processors
+
+El wizard compilado (main.scpt) no instala todos los paquetes que usan los
+processors. Si falta alguno, el processor termina con un mensaje claro en el
+log en vez de caerse con un ImportError.
+"""
+
+import sys
+import time
+import importlib.util
+
+
+def _installed(module: str) -> bool:
+    # find_spec de un submódulo (google.genai) falla si no existe el paquete padre
+    try:
+        return importlib.util.find_spec(module) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+def require(packages: dict[str, str]):
+    """
+    Termina el proceso si falta algún paquete.
+
+    Args:
+        packages: módulo a importar -> nombre del paquete en pip
+    """
+    missing = [pip_name for module, pip_name in packages.items()
+               if not _installed(module)]
+    if not missing:
+        return
+
+    ts = time.strftime('%Y-%m-%d %H:%M:%S')
+    print(f"[{ts}] ❌ Faltan dependencias Python: {', '.join(missing)}")
+    print(f"[{ts}]    Instálalas con: {sys.executable} -m pip install {' '.join(missing)}")
+    sys.exit(1)
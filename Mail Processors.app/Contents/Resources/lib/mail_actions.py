@@ -10,79 +10,95 @@ import subprocess
 from typing import Optional
 
 
-def mark_read_and_move(message_id: str, target_folder: str) -> bool:
-    """
-    Marca un mensaje como leído y lo mueve a una carpeta destino.
-    
-    Args:
-        message_id: ID único del mensaje (obtenido de AppleScript)
-        target_folder: Nombre de la carpeta destino (ej: "EECC", "Taxis")
-    
-    Returns:
-        True si tuvo éxito, False si falló
-    """
-    
-    # AppleScript para buscar el mensaje por ID, marcarlo y moverlo
-    script = f'''
+# Handler compartido: busca el mensaje por ID en todas las cuentas. Primero
+# en los inbox (donde está casi siempre al procesarlo) y solo si no aparece
+# recorre el resto de carpetas, que pueden tener miles de mensajes
+_FIND_MESSAGE = '''
+on findMessage(mid)
     tell application "Mail"
-        -- Buscar el mensaje por ID en todas las cuentas
-        set targetMessage to missing value
-        set targetMailbox to missing value
+        repeat with acct in accounts
+            try
+                set msgs to (messages of inbox of acct whose id is mid)
+                if (count of msgs) > 0 then return item 1 of msgs
+            end try
+        end repeat
         
         repeat with acct in accounts
-            -- Buscar en inbox y subcarpetas
             repeat with mbx in mailboxes of acct
                 try
-                    set msgs to (messages of mbx whose id is {message_id})
-                    if (count of msgs) > 0 then
-                        set targetMessage to item 1 of msgs
-                        -- Buscar carpeta destino en esta cuenta
-                        try
-                            set targetMailbox to mailbox "{target_folder}" of acct
-                        end try
-                        exit repeat
-                    end if
+                    set msgs to (messages of mbx whose id is mid)
+                    if (count of msgs) > 0 then return item 1 of msgs
                 end try
             end repeat
-            if targetMessage is not missing value then exit repeat
         end repeat
-        
-        -- Si no encontramos en mailboxes directos, buscar en inbox
-        if targetMessage is missing value then
-            repeat with acct in accounts
-                try
-                    set inb to inbox of acct
-                    set msgs to (messages of inb whose id is {message_id})
-                    if (count of msgs) > 0 then
-                        set targetMessage to item 1 of msgs
-                        try
-                            set targetMailbox to mailbox "{target_folder}" of acct
-                        end try
-                        exit repeat
-                    end if
-                end try
-            end repeat
-        end if
-        
-        if targetMessage is missing value then
-            error "Mensaje no encontrado"
-        end if
-        
-        if targetMailbox is missing value then
-            error "Carpeta destino no encontrada"
-        end if
-        
-        -- Marcar como leído y mover
-        set read status of targetMessage to true
-        move targetMessage to targetMailbox
-        
-        return "OK"
     end tell
+    error "Mensaje no encontrado"
+end findMessage
+'''
+
+
+def _mail_script(action: str) -> str:
+    """
+    Arma un script fijo que recibe el ID del mensaje (y los parámetros de la
+    acción) por argv, así el texto no cambia entre llamadas y los valores
+    nunca se interpolan en el código AppleScript.
+    
+    La acción puede referirse al mensaje como theMessage y a los parámetros
+    como item 2, 3... of argv.
+    """
+    return f'''
+    {_FIND_MESSAGE}
+    
+    on run argv
+        set theMessage to findMessage((item 1 of argv) as integer)
+        tell application "Mail"
+            {action}
+        end tell
+        return "OK"
+    end run
     '''
+
+
+# La carpeta destino se busca en la misma cuenta del mensaje
+_MOVE_SCRIPT = _mail_script('''
+            set targetMailbox to missing value
+            try
+                set targetMailbox to mailbox (item 2 of argv) of account of mailbox of theMessage
+            end try
+            
+            if targetMailbox is missing value then
+                error "Carpeta destino no encontrada"
+            end if
+            
+            -- Marcar como leído y mover
+            set read status of theMessage to true
+            move theMessage to targetMailbox
+''')
+
+_MARK_READ_SCRIPT = _mail_script('''
+            set read status of theMessage to true
+''')
+
+_FLAG_SCRIPT = _mail_script('''
+            set flag index of theMessage to ((item 2 of argv) as integer)
+''')
+
+
+def _run_mail_action(script: str, *args, error_label: Optional[str] = None) -> bool:
+    """
+    Ejecuta uno de los scripts de arriba pasando args por argv.
+    
+    Si se pasa error_label, los errores se imprimen ("Error {error_label}").
+    
+    Returns:
+        True si tuvo éxito, False si falló
+    """
     
     try:
+        # El script va por stdin ('-'); los argumentos siguen llegando por argv
         result = subprocess.run(
-            ['osascript', '-e', script],
+            ['osascript', '-', *map(str, args)],
+            input=script,
             capture_output=True,
             text=True,
             timeout=30
@@ -90,18 +106,36 @@ def mark_read_and_move(message_id: str, target_folder: str) -> bool:
         
         if result.returncode == 0:
             return True
-        else:
-            print(f"❌ Error moviendo mensaje: {result.stderr}")
-            return False
+        if error_label:
+            print(f"❌ Error {error_label}: {result.stderr}")
+        return False
             
     except subprocess.TimeoutExpired:
-        print("❌ Timeout ejecutando osascript")
+        if error_label:
+            print("❌ Timeout ejecutando osascript")
         return False
     except Exception as e:
-        print(f"❌ Error ejecutando osascript: {e}")
+        if error_label:
+            print(f"❌ Error ejecutando osascript: {e}")
         return False
 
 
+def mark_read_and_move(message_id: str, target_folder: str) -> bool:
+    """
+    Marca un mensaje como leído y lo mueve a una carpeta destino.
+    
+    Args:
+        message_id: ID único del mensaje (obtenido de AppleScript)
+        target_folder: Nombre de la carpeta destino (ej: "EECC", "Taxis")
+    
+    Returns:
+        True si tuvo éxito, False si falló
+    """
+    
+    return _run_mail_action(_MOVE_SCRIPT, message_id, target_folder,
+                            error_label="moviendo mensaje")
+
+
 def mark_read_only(message_id: str) -> bool:
     """
     Solo marca un mensaje como leído (sin mover).
@@ -114,41 +148,7 @@ def mark_read_only(message_id: str) -> bool:
         True si tuvo éxito, False si falló
     """
     
-    script = f'''
-    tell application "Mail"
-        repeat with acct in accounts
-            repeat with mbx in mailboxes of acct
-                try
-                    set msgs to (messages of mbx whose id is {message_id})
-                    if (count of msgs) > 0 then
-                        set read status of item 1 of msgs to true
-                        return "OK"
-                    end if
-                end try
-            end repeat
-            -- También buscar en inbox
-            try
-                set msgs to (messages of inbox of acct whose id is {message_id})
-                if (count of msgs) > 0 then
-                    set read status of item 1 of msgs to true
-                    return "OK"
-                end if
-            end try
-        end repeat
-        error "Mensaje no encontrado"
-    end tell
-    '''
-    
-    try:
-        result = subprocess.run(
-            ['osascript', '-e', script],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        return result.returncode == 0
-    except:
-        return False
+    return _run_mail_action(_MARK_READ_SCRIPT, message_id)
 
 
 def flag_message(message_id: str, flag_index: int = 1) -> bool:
@@ -165,41 +165,7 @@ def flag_message(message_id: str, flag_index: int = 1) -> bool:
         True si tuvo éxito, False si falló
     """
     
-    script = f'''
-    tell application "Mail"
-        repeat with acct in accounts
-            repeat with mbx in mailboxes of acct
-                try
-                    set msgs to (messages of mbx whose id is {message_id})
-                    if (count of msgs) > 0 then
-                        set flag index of item 1 of msgs to {flag_index}
-                        return "OK"
-                    end if
-                end try
-            end repeat
-            -- También buscar en inbox
-            try
-                set msgs to (messages of inbox of acct whose id is {message_id})
-                if (count of msgs) > 0 then
-                    set flag index of item 1 of msgs to {flag_index}
-                    return "OK"
-                end if
-            end try
-        end repeat
-        error "Mensaje no encontrado"
-    end tell
-    '''
-    
-    try:
-        result = subprocess.run(
-            ['osascript', '-e', script],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        return result.returncode == 0
-    except:
-        return False
+    return _run_mail_action(_FLAG_SCRIPT, message_id, flag_index)
 
 
 if __name__ == '__main__':
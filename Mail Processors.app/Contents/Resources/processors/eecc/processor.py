@@ -12,24 +12,25 @@ import os
 # Agregar lib al path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
 
+# El wizard no instala todo: si falta un paquete, error claro en el log
+from deps import require
+require({'pydantic': 'pydantic', 'pikepdf': 'pikepdf', 'google.genai': 'google-genai'})
+
+import io
 import csv
-import json
-import email
 from email import policy
-import shutil
-import tempfile
-import subprocess
+from email.parser import BytesParser
+import time
 import argparse
+import functools
 from pathlib import Path
 from datetime import datetime
-from typing import List, Optional
+from typing import Iterator, List, Optional
 
-from google import genai
-from google.genai import types
 from pydantic import BaseModel, Field
 
 from config import (
-    GEMINI_API_KEY, OUTPUT_FOLDER, QPDF_PATH, PDF_PASSWORD,
+    GEMINI_API_KEY, OUTPUT_FOLDER, PDF_PASSWORD,
     EECC_FOLDER, EECC_ERROR_LOG, ensure_folders
 )
 from mail_actions import mark_read_and_move
@@ -71,47 +72,100 @@ class ExtractedStatement(BaseModel):
 # ============================================================================
 
 def log(msg: str):
-    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"[{ts}] {msg}")
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
 
 
-def extract_pdfs_from_eml(eml_path: Path) -> list[tuple[str, bytes]]:
-    """Extrae todos los PDFs de un .eml"""
+def extract_pdfs_from_eml(eml_path: Path) -> Iterator[tuple[str, bytes]]:
+    """Recorre los PDFs de un .eml, decodificando cada uno solo al pedirlo"""
     with open(eml_path, 'rb') as f:
-        msg = email.message_from_binary_file(f, policy=policy.default)
+        msg = BytesParser(policy=policy.default).parse(f)
     
-    pdfs = []
+    count = 0
     for part in msg.walk():
+        # Los contenedores multipart nunca son el PDF
+        if part.is_multipart():
+            continue
+        
         content_type = part.get_content_type()
         filename = part.get_filename()
         
         if content_type == 'application/pdf' or (filename and filename.lower().endswith('.pdf')):
             payload = part.get_payload(decode=True)
             if payload:
-                name = filename or f"attachment_{len(pdfs)}.pdf"
-                pdfs.append((name, payload))
+                name = filename or f"attachment_{count}.pdf"
+                count += 1
+                yield name, payload
+
+
+def is_password_protected(content: bytes) -> bool:
+    # Un PDF cifrado siempre declara /Encrypt en su trailer (o en el
+    # diccionario del xref stream, que nunca va comprimido)
+    if b'/Encrypt' not in content:
+        return False
     
-    return pdfs
+    import pikepdf
+    try:
+        with pikepdf.open(io.BytesIO(content)) as pdf:
+            return pdf.is_encrypted
+    except pikepdf.PasswordError:
+        return True
+    except pikepdf.PdfError:
+        return False
 
 
-def is_password_protected(pdf_path: Path) -> bool:
-    result = subprocess.run([QPDF_PATH, '--is-encrypted', str(pdf_path)], capture_output=True)
-    return result.returncode == 0
+def remove_password(content: bytes) -> Optional[io.BytesIO]:
+    """Descifra el PDF en memoria, sin pasar por disco"""
+    import pikepdf
+    output = io.BytesIO()
+    try:
+        with pikepdf.open(io.BytesIO(content), password=PDF_PASSWORD) as pdf:
+            pdf.save(output)
+    except pikepdf.PdfError:
+        return None
+    output.seek(0)
+    return output
 
 
-def remove_password(input_path: Path, output_path: Path) -> bool:
-    result = subprocess.run(
-        [QPDF_PATH, '--decrypt', f'--password={PDF_PASSWORD}', str(input_path), str(output_path)],
-        capture_output=True, text=True
-    )
-    return result.returncode == 0
+# Gemini acepta requests inline de hasta 20 MB; el PDF viaja en base64 (+33%)
+INLINE_PDF_LIMIT = 14 * 1024 * 1024
 
 
-def extract_statement(pdf_path: str) -> ExtractedStatement:
+@functools.lru_cache(maxsize=1)
+def _get_client():
+    """Cliente de Gemini reutilizado durante todo el proceso"""
+    import importlib.util
+    import httpx
+    from google import genai
+    from google.genai import types
+    
+    # client_args existe desde google-genai 1.11; el wizard puede haber instalado
+    # una versión anterior, que se queda con el transporte por defecto
+    if 'client_args' not in types.HttpOptions.model_fields:
+        return genai.Client(api_key=GEMINI_API_KEY)
+    
+    # HTTP/2 + keep-alive: upload y generate comparten la conexión TLS
+    # httpx exige el paquete h2 para HTTP/2; sin él se queda en HTTP/1.1
+    http_options = types.HttpOptions(client_args={
+        'http2': importlib.util.find_spec('h2') is not None,
+        'limits': httpx.Limits(max_keepalive_connections=4, max_connections=4),
+    })
+    return genai.Client(api_key=GEMINI_API_KEY, http_options=http_options)
+
+
+def extract_statement(pdf: io.BytesIO) -> ExtractedStatement:
     """Extrae movimientos del PDF usando Gemini"""
-    client = genai.Client(api_key=GEMINI_API_KEY)
+    from google.genai import types
+    
+    client = _get_client()
     
-    uploaded_file = client.files.upload(file=pdf_path)
+    # PDFs chicos van inline en el request: se ahorra el round trip del upload
+    if pdf.getbuffer().nbytes <= INLINE_PDF_LIMIT:
+        document = types.Part.from_bytes(data=pdf.getvalue(), mime_type='application/pdf')
+    else:
+        document = client.files.upload(
+            file=pdf,
+            config=types.UploadFileConfig(mime_type='application/pdf'),
+        )
     
     prompt = """
 Analiza este documento y determina si es un estado de cuenta de tarjeta de crédito.
@@ -138,7 +192,7 @@ Analiza este documento y determina si es un estado de cuenta de tarjeta de créd
     
     response = client.models.generate_content(
         model='gemini-2.5-flash',
-        contents=[prompt, uploaded_file],
+        contents=[prompt, document],
         config=types.GenerateContentConfig(
             response_mime_type='application/json',
             response_schema=ExtractedStatement,
@@ -146,7 +200,7 @@ Analiza este documento y determina si es un estado de cuenta de tarjeta de créd
         ),
     )
     
-    return ExtractedStatement(**json.loads(response.text))
+    return ExtractedStatement.model_validate_json(response.text)
 
 
 def generate_base_name(metadata: StatementMetadata) -> str:
@@ -160,24 +214,28 @@ def generate_base_name(metadata: StatementMetadata) -> str:
     return f"{metadata.tipo_tarjeta} {metadata.banco} {year_month}"
 
 
-def export_csv(movements: List[Movement], output_path: str, moneda: str):
-    filtered = [m for m in movements if m.moneda == moneda]
-    if not filtered:
-        return False
-    
-    file_exists = Path(output_path).exists()
-    if not file_exists:
-        with open(output_path, 'wb') as f:
-            f.write(b'\xef\xbb\xbf')
+CSV_FIELDS = ('fecha', 'descripcion', 'monto', 'tipo')
+
+
+def export_csvs(movements: List[Movement], base_name: str):
+    """Exporta los movimientos a un CSV por moneda (PEN/USD) en una sola pasada"""
+    by_currency = {'PEN': [], 'USD': []}
+    for m in movements:
+        rows = by_currency.get(m.moneda)
+        if rows is not None:
+            rows.append((m.fecha, m.descripcion, m.monto, m.tipo))
     
-    with open(output_path, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=['fecha', 'descripcion', 'monto', 'tipo'])
-        if not file_exists:
-            writer.writeheader()
-        for mov in filtered:
-            writer.writerow({'fecha': mov.fecha, 'descripcion': mov.descripcion, 
-                           'monto': mov.monto, 'tipo': mov.tipo})
-    return True
+    for moneda, rows in by_currency.items():
+        if not rows:
+            log(f"ℹ️ Sin movimientos en {moneda}")
+            continue
+        
+        # utf-8-sig escribe el BOM (para Excel) solo si el archivo está vacío
+        with open(OUTPUT_FOLDER / f"{base_name} {moneda}.csv", 'a', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(CSV_FIELDS)
+            writer.writerows(rows)
 
 
 def process_eml(eml_path: str, message_id: str = None) -> bool:
@@ -187,68 +245,53 @@ def process_eml(eml_path: str, message_id: str = None) -> bool:
     
     log(f"📧 Procesando: {eml_path.name}")
     
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_dir = Path(temp_dir)
-        
-        # Extraer PDFs
-        pdfs = extract_pdfs_from_eml(eml_path)
-        if not pdfs:
-            log("❌ No se encontraron PDFs")
-            return False
-        
-        # Buscar PDF con password
-        decrypted_pdf = None
-        for filename, content in pdfs:
-            temp_pdf = temp_dir / filename
-            with open(temp_pdf, 'wb') as f:
-                f.write(content)
-            
-            if is_password_protected(temp_pdf):
-                decrypted = temp_dir / f"decrypted_{filename}"
-                if remove_password(temp_pdf, decrypted):
-                    decrypted_pdf = decrypted
-                    break
-        
-        if not decrypted_pdf:
-            log("❌ No se encontró PDF protegido")
-            return False
-        
-        # Procesar con Gemini
-        log("🤖 Extrayendo con Gemini...")
-        statement = extract_statement(str(decrypted_pdf))
-        
-        if not statement.metadata.es_estado_cuenta:
-            log("⚠️ No es un estado de cuenta válido")
-            return False
-        
-        # Generar archivos
-        base_name = generate_base_name(statement.metadata)
-        log(f"📁 {base_name}")
-        
-        # CSVs
-        if not export_csv(statement.movimientos, str(OUTPUT_FOLDER / f"{base_name} PEN.csv"), 'PEN'):
-            log("ℹ️ Sin movimientos en PEN")
-        if not export_csv(statement.movimientos, str(OUTPUT_FOLDER / f"{base_name} USD.csv"), 'USD'):
-            log("ℹ️ Sin movimientos en USD")
-        
-        # JSON
-        with open(OUTPUT_FOLDER / f"{base_name}.json", 'w', encoding='utf-8') as f:
-            json.dump({
-                'metadata': statement.metadata.model_dump(),
-                'movimientos': [m.model_dump() for m in statement.movimientos]
-            }, f, indent=2, ensure_ascii=False)
-        
-        # Copiar PDF
-        shutil.copy(decrypted_pdf, OUTPUT_FOLDER / f"{base_name}.pdf")
-        
-        log("✅ Procesado exitosamente")
-        
-        # Mover mensaje en Mail
-        if message_id:
-            if mark_read_and_move(message_id, EECC_FOLDER):
-                log("📬 Mensaje movido")
-        
-        return True
+    # Buscar PDF con password (los PDFs se decodifican de a uno)
+    found_pdf = False
+    decrypted_pdf = None
+    for filename, content in extract_pdfs_from_eml(eml_path):
+        found_pdf = True
+        if is_password_protected(content):
+            decrypted_pdf = remove_password(content)
+            if decrypted_pdf is not None:
+                break
+    
+    if not found_pdf:
+        log("❌ No se encontraron PDFs")
+        return False
+    
+    if decrypted_pdf is None:
+        log("❌ No se encontró PDF protegido")
+        return False
+    
+    # Procesar con Gemini
+    log("🤖 Extrayendo con Gemini...")
+    statement = extract_statement(decrypted_pdf)
+    
+    if not statement.metadata.es_estado_cuenta:
+        log("⚠️ No es un estado de cuenta válido")
+        return False
+    
+    # Generar archivos
+    base_name = generate_base_name(statement.metadata)
+    log(f"📁 {base_name}")
+    
+    # CSVs
+    export_csvs(statement.movimientos, base_name)
+    
+    # JSON
+    (OUTPUT_FOLDER / f"{base_name}.json").write_text(statement.model_dump_json(indent=2), encoding='utf-8')
+    
+    # Guardar PDF descifrado
+    (OUTPUT_FOLDER / f"{base_name}.pdf").write_bytes(decrypted_pdf.getvalue())
+    
+    log("✅ Procesado exitosamente")
+    
+    # Mover mensaje en Mail
+    if message_id:
+        if mark_read_and_move(message_id, EECC_FOLDER):
+            log("📬 Mensaje movido")
+    
+    return True
 
 
 def main():
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Taxi Client - Envía un .eml al processor en modo daemon
+
+Es lo que lanza la regla de Mail: no importa nada pesado, así que termina en
+milisegundos. Si el daemon no está corriendo, lo arranca en background para
+los próximos correos y procesa este directamente con processor.py.
+
+Uso:
+    python client.py <archivo.eml> [--message-id ID]
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import subprocess
+from pathlib import Path
+
+# Debe coincidir con SOCKET_PATH en processor.py
+SOCKET_PATH = Path('~/Library/Caches/mail_processors/taxi.sock').expanduser()
+PROCESSOR = Path(__file__).resolve().parent / 'processor.py'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('eml_file')
+    parser.add_argument('--message-id')
+    args = parser.parse_args()
+    
+    request = json.dumps({
+        'eml': str(Path(args.eml_file).resolve()),
+        'message_id': args.message_id,
+    }).encode('utf-8')
+    
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(SOCKET_PATH))
+            sock.sendall(request)
+        return
+    except OSError:
+        pass
+    
+    # Daemon no disponible: arrancarlo para los siguientes correos...
+    subprocess.Popen(
+        [sys.executable, str(PROCESSOR), '--daemon'],
+        stdin=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    
+    # ...y procesar este en el proceso actual
+    cmd = [sys.executable, str(PROCESSOR), args.eml_file]
+    if args.message_id:
+        cmd += ['--message-id', args.message_id]
+    os.execv(sys.executable, cmd)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,10 @@ Taxi Processor - Extrae información de viajes de taxi
 
 Uso:
     python processor.py <archivo.eml> [--message-id ID]
+    python processor.py --daemon
+
+En modo --daemon escucha pedidos de client.py por un unix socket, de modo que
+el arranque de Python y los imports se pagan una sola vez por ráfaga de correos.
 """
 
 import sys
@@ -12,19 +16,28 @@ import os
 # Agregar lib al path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
 
+# El wizard no instala todo: si falta un paquete, error claro en el log
+from deps import require
+require({'pydantic': 'pydantic', 'lxml': 'lxml', 'google.genai': 'google-genai'})
+
+import io
+import re
 import csv
 import json
-import email
+import fcntl
+import socket
 from email import policy
+from email.parser import BytesParser
+import time
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
+from typing import Optional
 
-from google import genai
-from google.genai import types
 from pydantic import BaseModel, Field
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+from lxml import etree, html as lxhtml
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -42,6 +55,12 @@ from config import (
 )
 from mail_actions import mark_read_and_move, flag_message
 
+# Socket del modo daemon (debe coincidir con client.py)
+SOCKET_PATH = Path('~/Library/Caches/mail_processors/taxi.sock').expanduser()
+DAEMON_IDLE_TIMEOUT = 600  # segundos sin pedidos antes de terminar
+DAEMON_WORKERS = 8         # correos procesados en paralelo (llamadas a Gemini)
+REQUEST_READ_TIMEOUT = 10  # segundos para recibir el pedido de client.py
+
 # Logger para reintentos
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -80,33 +99,7 @@ class TaxiTrip(BaseModel):
     es_viaje: bool = Field(default=True, description="False si es publicidad")
 
 
-# ============================================================================
-# FUNCIONES
-# ============================================================================
-
-def log(msg: str):
-    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"[{ts}] {msg}")
-
-
-def html_to_markdown(html_content: str) -> str:
-    """Convierte HTML a Markdown limpio"""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    for tag in soup(['script', 'style', 'meta', 'link', 'head']):
-        tag.decompose()
-    
-    markdown = md(str(soup), heading_style="ATX", strip=['img'])
-    lines = [line.strip() for line in markdown.split('\n')]
-    return '\n'.join(line for line in lines if line)
-
-
-@network_retry
-def extract_trip_info(markdown_content: str) -> TaxiTrip:
-    """Usa Gemini para extraer información del viaje (con reintentos automáticos)"""
-    client = genai.Client(api_key=GEMINI_API_KEY)
-    
-    prompt = """
+PROMPT = """
 Analiza este correo de taxi (Uber, Cabify, Beat, InDriver, DiDi).
 
 ## VALIDACIÓN
@@ -123,10 +116,77 @@ Analiza este correo de taxi (Uber, Cabify, Beat, InDriver, DiDi).
 
 CONTENIDO:
 """
+
+
+# ============================================================================
+# FUNCIONES
+# ============================================================================
+
+# El HTML ya viene decodificado; se re-codifica a UTF-8 para que lxml acepte
+# documentos con declaración de encoding
+_HTML_PARSER = lxhtml.HTMLParser(encoding='utf-8')
+
+# Elementos tras los cuales se corta la línea al extraer el texto
+_BLOCK_TAGS = ('p', 'div', 'br', 'tr', 'td', 'th', 'li', 'h1', 'h2', 'h3', 'h4', 'table')
+
+# Espacios dentro de una línea / espacios alrededor de saltos (incluye líneas vacías)
+_SPACES = re.compile(r'[^\S\n]+')
+_BLANK_LINES = re.compile(r'\s*\n\s*')
+
+
+def log(msg: str):
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+
+
+def html_to_text(html_content: str) -> str:
+    """Extrae el texto visible del HTML, una línea por bloque"""
+    try:
+        tree = lxhtml.document_fromstring(html_content.encode('utf-8'), parser=_HTML_PARSER)
+    except etree.ParserError:
+        # HTML vacío (o solo comentarios)
+        return ''
+    
+    etree.strip_elements(tree, 'script', 'style', 'meta', 'link', 'head', with_tail=False)
+    
+    # Evita que celdas/párrafos contiguos se peguen ("TotalS/ 12.50")
+    for element in tree.iter(*_BLOCK_TAGS):
+        element.tail = '\n' + (element.tail or '')
+    
+    text = _SPACES.sub(' ', tree.text_content())
+    return _BLANK_LINES.sub('\n', text).strip()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client():
+    """Cliente de Gemini reutilizado durante todo el proceso"""
+    import importlib.util
+    from google import genai
+    from google.genai import types
+    
+    # client_args existe desde google-genai 1.11; el wizard puede haber instalado
+    # una versión anterior, que se queda con el transporte por defecto
+    if 'client_args' not in types.HttpOptions.model_fields:
+        return genai.Client(api_key=GEMINI_API_KEY)
+    
+    # HTTP/2 + keep-alive: reintentos y llamadas sucesivas reutilizan la conexión TLS
+    # httpx exige el paquete h2 para HTTP/2; sin él se queda en HTTP/1.1
+    http_options = types.HttpOptions(client_args={
+        'http2': importlib.util.find_spec('h2') is not None,
+        'limits': httpx.Limits(max_keepalive_connections=4, max_connections=4),
+    })
+    return genai.Client(api_key=GEMINI_API_KEY, http_options=http_options)
+
+
+@network_retry
+def extract_trip_info(content: str) -> TaxiTrip:
+    """Usa Gemini para extraer información del viaje (con reintentos automáticos)"""
+    from google.genai import types
+    
+    client = _get_client()
     
     response = client.models.generate_content(
         model='gemini-2.5-flash',
-        contents=[prompt + "\n\n" + markdown_content],
+        contents=[PROMPT + "\n\n" + content],
         config=types.GenerateContentConfig(
             response_mime_type='application/json',
             response_schema=TaxiTrip,
@@ -134,33 +194,100 @@ CONTENIDO:
         ),
     )
     
-    return TaxiTrip(**json.loads(response.text))
+    return TaxiTrip.model_validate_json(response.text)
+
+
+CSV_FIELDS = ('fecha', 'hora', 'empresa', 'origen', 'destino', 'moneda', 'precio')
 
 
 def append_to_csv(trip: TaxiTrip):
     """Agrega el viaje al CSV consolidado"""
-    file_exists = TAXI_CSV.exists()
+    fd = os.open(TAXI_CSV, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o666)
+    try:
+        # Varias reglas de Mail pueden agregar viajes a la vez: con el lock,
+        # solo el primero escribe BOM + header
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        is_new = os.fstat(fd).st_size == 0
+        
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if is_new:
+            writer.writerow(CSV_FIELDS)
+        writer.writerow((
+            trip.fecha, trip.hora, trip.empresa, trip.origen,
+            trip.destino, trip.moneda, trip.precio
+        ))
+        
+        # Un solo write() sobre O_APPEND: la fila nunca queda intercalada
+        data = buffer.getvalue().encode('utf-8')
+        os.write(fd, b'\xef\xbb\xbf' + data if is_new else data)  # BOM para Excel
+    finally:
+        os.close(fd)
+
+
+def read_eml_content(eml_path: Path) -> Optional[str]:
+    """Obtiene el contenido del correo como texto (HTML limpio o texto plano)"""
+    with open(eml_path, 'rb') as f:
+        msg = BytesParser(policy=policy.default).parse(f)
     
-    if not file_exists:
-        with open(TAXI_CSV, 'wb') as f:
-            f.write(b'\xef\xbb\xbf')  # BOM para Excel
+    # Preferir HTML, sino texto; get_content() ya decodifica con el charset declarado
+    body = msg.get_body(preferencelist=('html', 'plain'))
+    if body is None:
+        return None
     
-    with open(TAXI_CSV, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=[
-            'fecha', 'hora', 'empresa', 'origen', 'destino', 'moneda', 'precio'
-        ])
-        if not file_exists:
-            writer.writeheader()
-        
-        writer.writerow({
-            'fecha': trip.fecha,
-            'hora': trip.hora,
-            'empresa': trip.empresa,
-            'origen': trip.origen,
-            'destino': trip.destino,
-            'moneda': trip.moneda,
-            'precio': trip.precio
-        })
+    if body.get_param('charset') is None:
+        # Sin charset declarado get_content() decodifica como ASCII y rompe los
+        # acentos; estos correos vienen en UTF-8
+        content = body.get_payload(decode=True).decode('utf-8', errors='replace')
+    else:
+        content = body.get_content()
+    
+    if body.get_content_type() == 'text/html':
+        return html_to_text(content) if content.strip() else None
+    return content
+
+
+def record_trip(trip: TaxiTrip, message_id: str = None) -> bool:
+    """Agrega el viaje al CSV y mueve el mensaje; marca con flag si no es viaje"""
+    if not trip.es_viaje:
+        log("⚠️ No es un recibo de viaje")
+        # Flag naranja - no es lo que esperábamos (queda unread)
+        if message_id:
+            log("🟠 Marcando con flag naranja (no es viaje)...")
+            flag_message(message_id, flag_index=2)
+        return False
+    
+    log(f"🚗 {trip.empresa}: {trip.origen} → {trip.destino}")
+    log(f"📅 {trip.fecha} {trip.hora} - {trip.moneda} {trip.precio}")
+    
+    # Agregar al CSV
+    append_to_csv(trip)
+    log(f"✅ Agregado a {TAXI_CSV}")
+    
+    # Solo mover y marcar read si procesamos OK
+    if message_id:
+        if mark_read_and_move(message_id, TAXI_FOLDER):
+            log("📬 Mensaje movido")
+    
+    return True
+
+
+def record_error(eml_path: Path, error: Exception, message_id: str = None):
+    """Guarda el error en el log y marca el mensaje con flag rojo"""
+    log(f"❌ Error en procesamiento: {error}")
+    
+    # Guardar error en log
+    with open(TAXI_ERROR_LOG, 'a') as f:
+        f.write(f"\n{'='*60}\n")
+        f.write(f"[{datetime.now()}] Error procesando {eml_path.name}\n")
+        f.write(f"{error}\n")
+        import traceback
+        f.write(traceback.format_exc())
+    
+    # Flag rojo - error de procesamiento (queda unread)
+    if message_id:
+        log("🚩 Marcando con flag rojo (error)...")
+        flag_message(message_id, flag_index=1)
 
 
 def process_eml(eml_path: str, message_id: str = None) -> bool:
@@ -171,30 +298,8 @@ def process_eml(eml_path: str, message_id: str = None) -> bool:
     log(f"📧 Procesando: {eml_path.name}")
     
     try:
-        # Leer correo
-        with open(eml_path, 'rb') as f:
-            msg = email.message_from_binary_file(f, policy=policy.default)
-        
-        # Obtener contenido
-        html_content = None
-        text_content = None
-        
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            if content_type == 'text/html':
-                payload = part.get_payload(decode=True)
-                charset = part.get_content_charset() or 'utf-8'
-                html_content = payload.decode(charset, errors='replace')
-            elif content_type == 'text/plain' and not html_content:
-                payload = part.get_payload(decode=True)
-                charset = part.get_content_charset() or 'utf-8'
-                text_content = payload.decode(charset, errors='replace')
-        
-        if html_content:
-            markdown = html_to_markdown(html_content)
-        elif text_content:
-            markdown = text_content
-        else:
+        content = read_eml_content(eml_path)
+        if not content:
             log("❌ No se encontró contenido")
             # Flag naranja - no pudimos leer el contenido
             if message_id:
@@ -204,67 +309,104 @@ def process_eml(eml_path: str, message_id: str = None) -> bool:
         
         # Extraer información (con reintentos automáticos)
         log("🤖 Extrayendo con Gemini...")
-        trip = extract_trip_info(markdown)
-        
-        if not trip.es_viaje:
-            log("⚠️ No es un recibo de viaje")
-            # Flag naranja - no es lo que esperábamos (queda unread)
-            if message_id:
-                log("🟠 Marcando con flag naranja (no es viaje)...")
-                flag_message(message_id, flag_index=2)
-            return False
-        
-        log(f"🚗 {trip.empresa}: {trip.origen} → {trip.destino}")
-        log(f"📅 {trip.fecha} {trip.hora} - {trip.moneda} {trip.precio}")
-        
-        # Agregar al CSV
-        append_to_csv(trip)
-        log(f"✅ Agregado a {TAXI_CSV}")
+        trip = extract_trip_info(content)
         
-        # Solo mover y marcar read si procesamos OK
-        if message_id:
-            if mark_read_and_move(message_id, TAXI_FOLDER):
-                log("📬 Mensaje movido")
-        
-        return True
+        return record_trip(trip, message_id)
         
     except Exception as e:
-        log(f"❌ Error en procesamiento: {e}")
+        record_error(eml_path, e, message_id)
+        return False
+
+
+def unlink_eml(eml_path: str):
+    """Elimina el .eml temporal"""
+    try:
+        Path(eml_path).unlink()
+        log("🗑️  EML temporal eliminado")
+    except:
+        pass
+
+
+def handle_request(conn: socket.socket):
+    """Atiende un pedido de client.py: {"eml": ..., "message_id": ...}"""
+    try:
+        # Un cliente que no termina de enviar no debe retener al worker
+        conn.settimeout(REQUEST_READ_TIMEOUT)
+        with conn, conn.makefile('rb') as f:
+            request = json.loads(f.read())
+        process_eml(request['eml'], request.get('message_id'))
+        unlink_eml(request['eml'])
+    except Exception as e:
+        log(f"❌ Pedido inválido: {e}")
+
+
+def serve():
+    """Modo daemon: procesa los .eml que envía client.py hasta quedar ocioso"""
+    # El log es un archivo: sin line buffering los mensajes llegarían tarde
+    sys.stdout.reconfigure(line_buffering=True)
+    SOCKET_PATH.parent.mkdir(parents=True, exist_ok=True)
+    
+    # Un solo daemon a la vez
+    lock_file = open(SOCKET_PATH.with_suffix('.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return
+    
+    SOCKET_PATH.unlink(missing_ok=True)
+    # Cada pedido va a un worker: una ráfaga de correos llama a Gemini en paralelo
+    # (las filas al CSV ya se serializan con flock en append_to_csv)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server, \
+            ThreadPoolExecutor(max_workers=DAEMON_WORKERS) as pool:
+        server.bind(str(SOCKET_PATH))
+        server.listen()
+        server.settimeout(DAEMON_IDLE_TIMEOUT)
+        log(f"👂 Daemon escuchando en {SOCKET_PATH}")
         
-        # Guardar error en log
-        with open(TAXI_ERROR_LOG, 'a') as f:
-            f.write(f"\n{'='*60}\n")
-            f.write(f"[{datetime.now()}] Error procesando {eml_path.name}\n")
-            f.write(f"{e}\n")
-            import traceback
-            f.write(traceback.format_exc())
+        # Pagar los imports de Gemini ahora y no en el primer pedido
+        _get_client()
         
-        # Flag rojo - error de procesamiento (queda unread)
-        if message_id:
-            log("🚩 Marcando con flag rojo (error)...")
-            flag_message(message_id, flag_index=1)
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            pool.submit(handle_request, conn)
         
-        return False
+        # Dejar de aceptar y atender lo que haya quedado en cola
+        SOCKET_PATH.unlink(missing_ok=True)
+        server.setblocking(False)
+        while True:
+            try:
+                conn, _ = server.accept()
+            except BlockingIOError:
+                break
+            pool.submit(handle_request, conn)
+    
+    log("💤 Daemon ocioso, terminando")
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('eml_file')
+    parser.add_argument('eml_file', nargs='?')
     parser.add_argument('--message-id')
+    parser.add_argument('--daemon', action='store_true')
     args = parser.parse_args()
     
+    if args.daemon:
+        serve()
+        return
+    
+    if not args.eml_file:
+        parser.error("falta el archivo .eml")
+    
     success = process_eml(args.eml_file, args.message_id)
     
     # Eliminar .eml temporal
-    try:
-        Path(args.eml_file).unlink()
-        log("🗑️  EML temporal eliminado")
-    except:
-        pass
+    unlink_eml(args.eml_file)
     
     sys.exit(0 if success else 1)
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Taxi Batch Processor - Procesa varios correos de taxi en una sola llamada a Gemini
+
+Agrupa los correos en bloques de hasta BATCH_SIZE y extrae todos los viajes
+de cada bloque con un único request (response_schema=List[TaxiTrip]).
+
+Uso:
+    python processor_batch.py --eml a.eml [--eml b.eml ...] [--message-id ID ...]
+
+Los --message-id se asocian por posición a cada --eml.
+"""
+
+import sys
+import argparse
+from pathlib import Path
+from typing import List, Optional
+
+from google.genai import types
+from pydantic import TypeAdapter
+
+from processor import (
+    TaxiTrip, PROMPT, log, network_retry, _get_client, read_eml_content,
+    record_trip, record_error, process_eml, ensure_folders, flag_message
+)
+
+# Máximo de correos por request (contexto del modelo)
+BATCH_SIZE = 20
+
+# Parseo + validación de la lista de viajes en una sola pasada
+_TRIPS_ADAPTER = TypeAdapter(List[TaxiTrip])
+
+BATCH_INSTRUCTIONS = """
+El contenido incluye {count} correos distintos, separados por "--- MESSAGE k ---".
+Devuelve una lista con exactamente un objeto por correo, en el mismo orden.
+"""
+
+
+@network_retry
+def extract_trips_batch(contents: List[str]) -> List[TaxiTrip]:
+    """Extrae los viajes de varios correos en un solo request a Gemini"""
+    client = _get_client()
+    
+    body = "".join(
+        f"\n\n--- MESSAGE {k} ---\n{content}"
+        for k, content in enumerate(contents, start=1)
+    )
+    
+    response = client.models.generate_content(
+        model='gemini-2.5-flash',
+        contents=[PROMPT + BATCH_INSTRUCTIONS.format(count=len(contents)) + body],
+        config=types.GenerateContentConfig(
+            response_mime_type='application/json',
+            response_schema=List[TaxiTrip],
+            temperature=0.1,
+        ),
+    )
+    
+    trips = _TRIPS_ADAPTER.validate_json(response.text)
+    if len(trips) != len(contents):
+        raise ValueError(f"Gemini devolvió {len(trips)} viajes para {len(contents)} correos")
+    return trips
+
+
+def process_batch(eml_paths: List[Path], message_ids: List[Optional[str]]) -> int:
+    """
+    Procesa un bloque de correos con una sola llamada a Gemini.
+    
+    Returns:
+        Cantidad de viajes registrados
+    """
+    pending = []
+    for eml_path, message_id in zip(eml_paths, message_ids):
+        log(f"📧 Procesando: {eml_path.name}")
+        try:
+            content = read_eml_content(eml_path)
+        except Exception as e:
+            record_error(eml_path, e, message_id)
+            continue
+        
+        if not content:
+            log(f"❌ No se encontró contenido en {eml_path.name}")
+            if message_id:
+                log("🟠 Marcando con flag naranja (sin contenido)...")
+                flag_message(message_id, flag_index=2)
+            continue
+        
+        pending.append((eml_path, message_id, content))
+    
+    if not pending:
+        return 0
+    
+    log(f"🤖 Extrayendo {len(pending)} correo(s) con Gemini...")
+    try:
+        trips = extract_trips_batch([content for _, _, content in pending])
+    except Exception as e:
+        # Si el batch falla, procesar uno por uno
+        log(f"⚠️ Batch falló ({e}), procesando individualmente")
+        return sum(process_eml(str(eml_path), message_id) for eml_path, message_id, _ in pending)
+    
+    recorded = 0
+    for (eml_path, message_id, _), trip in zip(pending, trips):
+        log(f"📧 {eml_path.name}")
+        try:
+            recorded += record_trip(trip, message_id)
+        except Exception as e:
+            record_error(eml_path, e, message_id)
+    
+    return recorded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--eml', action='append', required=True, dest='eml_files')
+    parser.add_argument('--message-id', action='append', default=[], dest='message_ids')
+    args = parser.parse_args()
+    
+    if args.message_ids and len(args.message_ids) != len(args.eml_files):
+        parser.error("debe haber un --message-id por cada --eml")
+    
+    eml_paths = [Path(p) for p in args.eml_files]
+    message_ids = args.message_ids or [None] * len(eml_paths)
+    
+    ensure_folders()
+    
+    recorded = 0
+    for i in range(0, len(eml_paths), BATCH_SIZE):
+        recorded += process_batch(eml_paths[i:i + BATCH_SIZE], message_ids[i:i + BATCH_SIZE])
+    
+    log(f"✅ {recorded}/{len(eml_paths)} viaje(s) registrados")
+    
+    # Eliminar .eml temporales
+    for eml_path in eml_paths:
+        try:
+            eml_path.unlink()
+        except:
+            pass
+    
+    sys.exit(0 if recorded == len(eml_paths) else 1)
+
+
+if __name__ == '__main__':
+    main()
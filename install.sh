@@ -30,106 +30,10 @@ else
 fi
 
 # =============================================================================
-# 2. Verificar/Instalar qpdf
+# 2. Crear/Actualizar config.toml
 # =============================================================================
 echo ""
-echo "2️⃣  Verificando qpdf..."
-
-if command -v qpdf &> /dev/null; then
-    QPDF_PATH=$(which qpdf)
-    echo "   ✓ Encontrado: $QPDF_PATH"
-else
-    echo "   ⚠️  qpdf no encontrado"
-    QPDF_INSTALLED=false
-    
-    # Intentar instalar con Homebrew si está disponible
-    if command -v brew &> /dev/null; then
-        echo "   📥 Instalando qpdf via Homebrew..."
-        if brew install qpdf 2>/dev/null; then
-            QPDF_PATH=$(which qpdf)
-            echo "   ✓ Instalado: $QPDF_PATH"
-            QPDF_INSTALLED=true
-        fi
-    fi
-    
-    # Intentar con MacPorts si Homebrew no funcionó
-    if [ "$QPDF_INSTALLED" = false ] && command -v port &> /dev/null; then
-        echo "   📥 Instalando qpdf via MacPorts..."
-        if sudo port install qpdf 2>/dev/null; then
-            QPDF_PATH=$(which qpdf)
-            echo "   ✓ Instalado: $QPDF_PATH"
-            QPDF_INSTALLED=true
-        fi
-    fi
-    
-    # Si no hay gestor de paquetes, ofrecer instalar Homebrew
-    if [ "$QPDF_INSTALLED" = false ]; then
-        echo ""
-        echo "   No se encontró Homebrew ni MacPorts."
-        echo "   Homebrew es el gestor de paquetes más popular para macOS."
-        echo ""
-        read -p "   ¿Deseas instalar Homebrew y qpdf automáticamente? [s/N] " -n 1 -r
-        echo ""
-        
-        if [[ $REPLY =~ ^[SsYy]$ ]]; then
-            echo ""
-            echo "   📥 Instalando Homebrew..."
-            echo "   (Esto puede tardar unos minutos)"
-            echo ""
-            
-            # Instalar Homebrew de forma no interactiva
-            NONINTERACTIVE=1 /bin/bash -c "$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)"
-            
-            # Agregar Homebrew al PATH para esta sesión
-            if [[ $(uname -m) == "arm64" ]]; then
-                eval "$(/opt/homebrew/bin/brew shellenv)"
-            else
-                eval "$(/usr/local/bin/brew shellenv)"
-            fi
-            
-            echo ""
-            echo "   ✓ Homebrew instalado"
-            echo ""
-            echo "   📥 Instalando qpdf..."
-            brew install qpdf
-            
-            if command -v qpdf &> /dev/null; then
-                QPDF_PATH=$(which qpdf)
-                echo "   ✓ qpdf instalado: $QPDF_PATH"
-                QPDF_INSTALLED=true
-            fi
-        fi
-    fi
-    
-    # Si aún no se instaló, dar instrucciones manuales
-    if [ "$QPDF_INSTALLED" = false ]; then
-        echo ""
-        echo "   ❌ qpdf no instalado"
-        echo ""
-        echo "   Para instalar manualmente:"
-        echo "   ┌─────────────────────────────────────────────────────────────┐"
-        echo "   │ Opción 1 - Homebrew:                                        │"
-        echo "   │   /bin/bash -c \"\$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)\""
-        echo "   │   brew install qpdf                                         │"
-        echo "   ├─────────────────────────────────────────────────────────────┤"
-        echo "   │ Opción 2 - MacPorts:                                        │"
-        echo "   │   https://www.macports.org/install.php                      │"
-        echo "   │   sudo port install qpdf                                    │"
-        echo "   └─────────────────────────────────────────────────────────────┘"
-        echo ""
-        echo "   Después de instalar qpdf, ejecuta ./install.sh de nuevo"
-        echo ""
-        
-        # Usar path por defecto
-        QPDF_PATH="/opt/homebrew/bin/qpdf"
-    fi
-fi
-
-# =============================================================================
-# 3. Crear/Actualizar config.toml
-# =============================================================================
-echo ""
-echo "3️⃣  Configurando..."
+echo "2️⃣  Configurando..."
 
 mkdir -p config
 
@@ -150,11 +54,6 @@ if [ -n "$PYTHON_PATH" ]; then
     echo "   ✓ python_path actualizado: $PYTHON_PATH"
 fi
 
-if [ -n "$QPDF_PATH" ]; then
-    sed -i '' "s|qpdf_path = \".*\"|qpdf_path = \"$QPDF_PATH\"|" config/config.toml
-    echo "   ✓ qpdf_path actualizado: $QPDF_PATH"
-fi
-
 if [ "$CONFIG_CREATED" = true ]; then
     echo ""
     echo "   ⚠️  ¡IMPORTANTE! Edita config/config.toml con tus valores:"
@@ -164,30 +63,30 @@ if [ "$CONFIG_CREATED" = true ]; then
 fi
 
 # =============================================================================
-# 4. Crear carpetas necesarias
+# 3. Crear carpetas necesarias
 # =============================================================================
 echo ""
-echo "4️⃣  Creando carpetas..."
+echo "3️⃣  Creando carpetas..."
 mkdir -p ~/Library/MailEML
 echo "   ✓ ~/Library/MailEML"
 
 # =============================================================================
-# 5. Instalar dependencias Python
+# 4. Instalar dependencias Python
 # =============================================================================
 echo ""
-echo "5️⃣  Instalando dependencias Python..."
-echo "   - google-genai (Gemini AI SDK)"
+echo "4️⃣  Instalando dependencias Python..."
+echo "   - google-genai + h2 (Gemini AI SDK, HTTP/2)"
 echo "   - pydantic (validación de datos)"
-echo "   - beautifulsoup4 (procesamiento HTML)"
-echo "   - markdownify (conversión HTML→Markdown)"
+echo "   - pikepdf (descifrado de PDFs)"
+echo "   - lxml (procesamiento HTML)"
 "$PYTHON_PATH" -m pip install -r requirements.txt --quiet --disable-pip-version-check
 echo "   ✓ Todas las dependencias instaladas"
 
 # =============================================================================
-# 6. Compilar AppleScripts e instalar en Mail
+# 5. Compilar AppleScripts e instalar en Mail
 # =============================================================================
 echo ""
-echo "6️⃣  Compilando AppleScripts..."
+echo "5️⃣  Compilando AppleScripts..."
 
 MAIL_SCRIPTS_DIR="$HOME/Library/Application Scripts/com.apple.mail"
 mkdir -p "$MAIL_SCRIPTS_DIR"
@@ -222,7 +121,7 @@ rm -rf "$TEMP_DIR"
 echo "   📁 Instalados en: $MAIL_SCRIPTS_DIR/"
 
 # =============================================================================
-# 7. Resumen final
+# 6. Resumen final
 # =============================================================================
 echo ""
 echo "======================================="
@@ -230,7 +129,6 @@ echo "✅ Instalación completada!"
 echo ""
 echo "📋 Configuración detectada:"
 echo "   Python: $PYTHON_PATH"
-echo "   qpdf:   $QPDF_PATH"
 echo ""
 
 if [ "$CONFIG_CREATED" = true ]; then
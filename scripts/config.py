@@ -3,13 +3,17 @@
 Módulo de configuración - Carga config.toml
 """
 
-import tomllib
+import functools
+import tempfile
 from pathlib import Path
 
+from config_cache import load_config
+
 # Ruta al archivo de configuración
 CONFIG_DIR = Path(__file__).parent.parent / "config"
 CONFIG_FILE = CONFIG_DIR / "config.toml"
 
+
 # Cargar configuración
 if not CONFIG_FILE.exists():
     raise FileNotFoundError(
@@ -17,8 +21,7 @@ if not CONFIG_FILE.exists():
         f"Copia config.example.toml a config/config.toml y edita con tus valores."
     )
 
-with open(CONFIG_FILE, "rb") as f:
-    _config = tomllib.load(f)
+_config = load_config(CONFIG_FILE)
 
 # =============================================================================
 # Exportar valores de configuración
@@ -38,8 +41,10 @@ if not GEMINI_API_KEY or GEMINI_API_KEY.startswith("YOUR_"):
 # Paths
 OUTPUT_FOLDER = Path(_config["paths"]["output_folder"]).expanduser()
 PYTHON_PATH = _config["paths"]["python_path"]
-QPDF_PATH = _config["paths"]["qpdf_path"]
-EML_TEMP_FOLDER = Path(_config["paths"]["eml_temp_folder"]).expanduser()
+# Si no se configura, usar el directorio temporal del sistema
+EML_TEMP_FOLDER = Path(
+    _config["paths"].get("eml_temp_folder") or Path(tempfile.gettempdir()) / "apple_mail_eml"
+).expanduser()
 
 # Mail
 EECC_FOLDER = _config["mail"]["eecc_folder"]
@@ -61,8 +66,9 @@ TAXI_ERROR_LOG = OUTPUT_FOLDER / "errores_taxi.log"
 SCRIPTS_DIR = Path(__file__).parent
 
 
+@functools.lru_cache(maxsize=1)
 def ensure_folders():
-    """Crea las carpetas necesarias si no existen"""
+    """Crea las carpetas necesarias si no existen (una vez por proceso)"""
     OUTPUT_FOLDER.mkdir(parents=True, exist_ok=True)
     EML_TEMP_FOLDER.mkdir(parents=True, exist_ok=True)
 
@@ -72,7 +78,6 @@ if __name__ == '__main__':
     print("Configuración cargada:")
     print(f"  OUTPUT_FOLDER: {OUTPUT_FOLDER}")
     print(f"  PYTHON_PATH: {PYTHON_PATH}")
-    print(f"  QPDF_PATH: {QPDF_PATH}")
     print(f"  EML_TEMP_FOLDER: {EML_TEMP_FOLDER}")
     print(f"  EECC_FOLDER: {EECC_FOLDER}")
     print(f"  TAXI_FOLDER: {TAXI_FOLDER}")
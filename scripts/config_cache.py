@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Carga de config.toml con cache pickle
+
+Copia de lib/config_cache.py de la app, para que scripts/ funcione sin
+el .app al lado: mantener ambas en sync.
+"""
+
+import os
+import pickle
+import tomllib
+from pathlib import Path
+
+
+def load_config(config_file: Path) -> dict:
+    """
+    Carga config.toml usando un cache pickle junto al archivo.
+
+    El cache se invalida cuando config.toml es más nuevo que el pickle. Como
+    guarda la API key y el password de los PDFs, solo lo puede leer el dueño.
+    """
+    cache_file = config_file.with_suffix('.toml.pkl')
+
+    try:
+        cache_stat = cache_file.stat()
+        # Un cache legible por otros (versiones anteriores) se vuelve a escribir
+        if (cache_stat.st_mtime >= config_file.stat().st_mtime
+                and not cache_stat.st_mode & 0o077):
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    with open(config_file, "rb") as f:
+        config = tomllib.load(f)
+
+    # Escritura atómica: otro proceso puede estar leyendo el cache
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    try:
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # El modo de os.open no aplica si el temporal ya existía
+        os.fchmod(fd, 0o600)
+        with open(fd, 'wb') as f:
+            pickle.dump(config, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        tmp_file.unlink(missing_ok=True)
+
+    return config
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+CSV Append - Escritura concurrente de CSVs en modo append
+
+Compartido por extract_movements.py y extract_taxi_trip.py: la regla de Mail
+puede lanzar varios procesos que escriben al mismo CSV a la vez.
+"""
+
+import io
+import csv
+import fcntl
+
+
+class CsvAppender:
+    """
+    Abre un CSV en modo append con lock exclusivo (flock), para que varios
+    procesos del batch puedan escribir al mismo archivo sin mezclar filas.
+    
+    Si el archivo está vacío escribe el BOM (para Excel) y el header.
+    
+    Uso:
+        with CsvAppender(path, fields) as writer:
+            writer.writerows(rows)
+    """
+    
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+    
+    def __enter__(self):
+        # Buffer de 64 KB: todo el CSV sale en uno o pocos write() al cerrar
+        raw = open(self.path, 'ab', buffering=1 << 16)
+        try:
+            fcntl.flock(raw, fcntl.LOCK_EX)
+            
+            # El tamaño se mide con el lock tomado: otro proceso pudo escribir antes
+            is_new = raw.seek(0, io.SEEK_END) == 0
+            
+            # utf-8-sig solo escribe el BOM si la posición inicial es 0
+            self._file = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+            writer = csv.writer(self._file)
+            if is_new:
+                writer.writerow(self.fields)
+        except BaseException:
+            # __exit__ no corre si __enter__ falla: cerrar acá (libera el lock)
+            raw.close()
+            raise
+        return writer
+    
+    def __exit__(self, *exc):
+        # Al cerrar se vacía el buffer y se libera el lock
+        self._file.close()
+        return False
@@ -6,24 +6,37 @@ Extrae el PDF protegido, le quita la contraseña, y lo procesa con extract_movem
 
 Uso:
     python extract_from_email.py <archivo.eml> [--message-id ID]
+    python extract_from_email.py --batch <carpeta|glob> [--workers N]
 
 El --message-id es opcional y se usa para marcar como leído y mover el mensaje
 en Mail.app después de un procesamiento exitoso.
+
+Con --batch se procesan en paralelo todos los .eml de una carpeta (o los que
+coincidan con el glob); los archivos no se eliminan.
 """
 
+import re
 import sys
-import email
+import mmap
+import base64
+import binascii
+import itertools
 from email import policy
+from email.parser import BytesParser
 import tempfile
-import subprocess
+import threading
+import traceback
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
+from typing import Iterable, Iterator
+
+import pikepdf
 
 # Importar configuración
 from config import (
     OUTPUT_FOLDER, 
-    QPDF_PATH, 
     PDF_PASSWORD,
     EECC_FOLDER,
     EECC_ERROR_LOG,
@@ -31,6 +44,10 @@ from config import (
 )
 from mail_actions import mark_read_and_move, flag_message
 
+# Máximo de llamadas simultáneas a Gemini en modo batch (rate limit)
+GEMINI_MAX_CONCURRENT = 4
+_gemini_slots = threading.Semaphore(GEMINI_MAX_CONCURRENT)
+
 
 def log(msg: str):
     """Log con timestamp"""
@@ -38,93 +55,136 @@ def log(msg: str):
     print(f"[{ts}] {msg}")
 
 
-def extract_pdfs_from_eml(eml_path: Path) -> list[tuple[str, bytes]]:
+# Cabeceras de un adjunto PDF: tipo MIME o nombre (filename=/name=, también en
+# formato RFC 2231). Los nombres codificados (=?utf-8?...) se aceptan siempre
+# porque sin decodificarlos no se puede ver la extensión. El valor puede venir
+# plegado en varias líneas (salto seguido de espacio o tab).
+_PDF_HEADER_RE = re.compile(
+    rb'(?i)application/pdf|name\*?(?:\d+\*?)?=(?:[^\r\n]|\r?\n[ \t])*?(?:\.pdf|=\?)'
+)
+
+
+def _has_pdf_attachment(eml_path: Path) -> bool:
+    """Búsqueda rápida (sin parsear MIME) de algún adjunto PDF en el .eml"""
+    with open(eml_path, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _PDF_HEADER_RE.search(data) is not None
+        except ValueError:
+            # Archivo vacío: mmap no acepta largo 0
+            return False
+
+
+# Tamaño de bloque para decodificar adjuntos base64 sin armar el PDF entero en memoria
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# Todo lo que no es del alfabeto base64 (saltos de línea, basura): se descarta
+# antes de agrupar de a 4, como hace el decoder de la librería email
+_BASE64_JUNK_RE = re.compile(r'[^A-Za-z0-9+/=]+')
+
+
+def write_base64(data: str, output_path: Path):
     """
-    Extrae todos los PDFs de un archivo .eml
+    Decodifica un payload base64 directo a disco, por bloques.
     
-    Returns:
-        Lista de tuplas (filename, contenido_bytes)
+    El texto base64 ya está entero en memoria (el mensaje se parsea completo);
+    lo que se evita es tener además una copia decodificada del PDF.
+    """
+    pending = b''
+    with open(output_path, 'wb') as f:
+        for i in range(0, len(data), DECODE_CHUNK_SIZE):
+            # Quitar lo que no es base64 y decodificar solo grupos completos de 4
+            chunk = pending + _BASE64_JUNK_RE.sub('', data[i:i + DECODE_CHUNK_SIZE]).encode('ascii')
+            cut = len(chunk) - len(chunk) % 4
+            f.write(base64.b64decode(chunk[:cut]))
+            pending = chunk[cut:]
+        if pending:
+            f.write(base64.b64decode(pending + b'=' * (-len(pending) % 4)))
+
+
+def extract_pdfs_from_eml(eml_path: Path, temp_dir: Path) -> Iterator[Path]:
+    """
+    Extrae los PDFs de un archivo .eml a temp_dir, de a uno y a demanda:
+    si el consumidor deja de iterar, los PDFs restantes no se decodifican.
+    
+    Yields:
+        Path a cada PDF extraído
     """
     with open(eml_path, 'rb') as f:
-        msg = email.message_from_binary_file(f, policy=policy.default)
+        msg = BytesParser(policy=policy.default).parse(f)
     
-    pdfs = []
+    count = 0
     
     for part in msg.walk():
+        # Los contenedores multipart nunca son el PDF
+        if part.is_multipart():
+            continue
+        
         content_type = part.get_content_type()
         filename = part.get_filename()
         
         # Buscar PDFs
         if content_type == 'application/pdf' or (filename and filename.lower().endswith('.pdf')):
-            payload = part.get_payload(decode=True)
-            if payload:
-                name = filename or f"attachment_{len(pdfs)}.pdf"
-                pdfs.append((name, payload))
-                log(f"📎 Encontrado PDF: {name} ({len(payload)} bytes)")
-    
-    return pdfs
-
-
-def is_password_protected(pdf_path: Path) -> bool:
-    """Verifica si un PDF está protegido con contraseña"""
-    result = subprocess.run(
-        [QPDF_PATH, '--is-encrypted', str(pdf_path)],
-        capture_output=True
-    )
-    return result.returncode == 0
-
-
-def remove_password(input_path: Path, output_path: Path) -> bool:
-    """Quita la contraseña de un PDF"""
-    result = subprocess.run(
-        [
-            QPDF_PATH,
-            '--decrypt',
-            f'--password={PDF_PASSWORD}',
-            str(input_path),
-            str(output_path)
-        ],
-        capture_output=True,
-        text=True
-    )
-    
-    if result.returncode != 0:
-        log(f"❌ Error qpdf: {result.stderr}")
-        return False
-    
-    return True
+            # Solo el nombre: el adjunto no decide dónde se escribe
+            name = Path(filename).name if filename else f"attachment_{count}.pdf"
+            pdf_path = temp_dir / f"{count}_{name}"
+            
+            if part.get('Content-Transfer-Encoding', '').strip().lower() == 'base64':
+                try:
+                    write_base64(part.get_payload(decode=False), pdf_path)
+                except binascii.Error:
+                    # Padding roto: el decoder tolerante de email sí lo resuelve
+                    pdf_path.write_bytes(part.get_payload(decode=True) or b'')
+            else:
+                pdf_path.write_bytes(part.get_payload(decode=True) or b'')
+            
+            size = pdf_path.stat().st_size
+            if size:
+                count += 1
+                log(f"📎 Encontrado PDF: {name} ({size} bytes)")
+                yield pdf_path
+            else:
+                pdf_path.unlink()
 
 
-def find_and_decrypt_statement(pdfs: list[tuple[str, bytes]], temp_dir: Path) -> Path | None:
+def find_and_decrypt_statement(pdfs: Iterable[Path], output_path: Path) -> bool:
     """
     De la lista de PDFs, encuentra el estado de cuenta (el que tiene password)
-    y lo descifra.
+    y lo descifra directamente en output_path.
     
     Returns:
-        Path al PDF descifrado, o None si no encuentra
+        True si se descifró el estado de cuenta
     """
-    for filename, content in pdfs:
-        # Guardar temporalmente
-        temp_pdf = temp_dir / filename
-        with open(temp_pdf, 'wb') as f:
-            f.write(content)
+    for temp_pdf in pdfs:
+        filename = temp_pdf.name
         
-        # ¿Tiene password?
-        if is_password_protected(temp_pdf):
-            log(f"🔐 PDF protegido encontrado: {filename}")
-            
-            # Descifrar
-            decrypted = temp_dir / f"decrypted_{filename}"
-            if remove_password(temp_pdf, decrypted):
-                log(f"🔓 PDF descifrado: {decrypted.name}")
-                return decrypted
-            else:
-                log(f"❌ No se pudo descifrar {filename}")
-                return None
-        else:
+        # Sin diccionario /Encrypt no está cifrado y no hace falta abrirlo
+        if b'/Encrypt' not in temp_pdf.read_bytes():
             log(f"ℹ️  {filename} no tiene password, ignorando")
+            continue
+        
+        # Abrir con el password, verificar y guardar descifrado en una pasada
+        try:
+            with pikepdf.open(temp_pdf, password=PDF_PASSWORD) as pdf:
+                if not pdf.is_encrypted:
+                    log(f"ℹ️  {filename} no tiene password, ignorando")
+                    continue
+                
+                log(f"🔐 PDF protegido encontrado: {filename}")
+                # /ID determinístico: el mismo estado de cuenta da siempre los mismos bytes
+                pdf.save(output_path, deterministic_id=True)
+        except pikepdf.PasswordError:
+            log(f"🔐 PDF protegido encontrado: {filename}")
+            log(f"❌ No se pudo descifrar {filename}: password incorrecto")
+            return False
+        except pikepdf.PdfError as e:
+            log(f"⚠️  {filename} no es un PDF válido, ignorando: {e}")
+            continue
+        
+        log(f"🔓 PDF descifrado: {filename}")
+        return True
     
-    return None
+    return False
 
 
 def process_eml(eml_path: str, message_id: str = None):
@@ -142,32 +202,32 @@ def process_eml(eml_path: str, message_id: str = None):
     
     log(f"📧 Procesando: {eml_path.name}")
     
+    # Descartar correos sin PDF antes de parsear el MIME completo
+    if not _has_pdf_attachment(eml_path):
+        log("❌ No se encontraron PDFs en el correo")
+        return False
+    
     # Crear directorio temporal
     with tempfile.TemporaryDirectory() as temp_dir:
         temp_dir = Path(temp_dir)
         
-        # Extraer PDFs
-        pdfs = extract_pdfs_from_eml(eml_path)
+        # Extraer PDFs (se decodifican a medida que se revisan)
+        pdfs = extract_pdfs_from_eml(eml_path, temp_dir)
+        first_pdf = next(pdfs, None)
         
-        if not pdfs:
+        if first_pdf is None:
             log("❌ No se encontraron PDFs en el correo")
             return False
         
-        log(f"📎 {len(pdfs)} PDF(s) encontrado(s)")
-        
-        # Encontrar y descifrar el estado de cuenta
-        decrypted_pdf = find_and_decrypt_statement(pdfs, temp_dir)
+        # Encontrar el estado de cuenta y descifrarlo en el directorio
+        # temporal; process_pdf lo mueve a OUTPUT_FOLDER con su nombre final
+        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_pdf = temp_dir / f"temp_eecc_{ts}.pdf"
         
-        if not decrypted_pdf:
+        if not find_and_decrypt_statement(itertools.chain([first_pdf], pdfs), output_pdf):
             log("❌ No se encontró un estado de cuenta protegido")
             return False
         
-        # Copiar a carpeta de salida con nombre temporal
-        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_pdf = OUTPUT_FOLDER / f"temp_eecc_{ts}.pdf"
-        
-        import shutil
-        shutil.copy(decrypted_pdf, output_pdf)
         log(f"📁 PDF guardado temporalmente: {output_pdf}")
         
         # Procesar con extract_movements.py
@@ -177,7 +237,8 @@ def process_eml(eml_path: str, message_id: str = None):
         from extract_movements import process_pdf
         
         try:
-            success, _ = process_pdf(str(output_pdf), OUTPUT_FOLDER)
+            with _gemini_slots:
+                success, _ = process_pdf(str(output_pdf), OUTPUT_FOLDER)
             
             if success:
                 log("✅ Procesamiento exitoso")
@@ -193,9 +254,6 @@ def process_eml(eml_path: str, message_id: str = None):
                 return True
             else:
                 log("⚠️  El documento no es un estado de cuenta válido")
-                # Limpiar PDF temporal si no se procesó
-                if output_pdf.exists():
-                    output_pdf.unlink()
                 
                 # Flag naranja = no es lo que esperábamos (queda unread)
                 if message_id:
@@ -215,7 +273,6 @@ def process_eml(eml_path: str, message_id: str = None):
                 f.write(f"\n{'='*60}\n")
                 f.write(f"[{datetime.now()}] Error procesando {eml_path.name}\n")
                 f.write(f"{e}\n")
-                import traceback
                 f.write(traceback.format_exc())
             
             # Poner flag rojo al mensaje para indicar que falló
@@ -229,13 +286,58 @@ def process_eml(eml_path: str, message_id: str = None):
             return False
 
 
+def process_eml_batch(paths: list[Path], workers: int = 8) -> bool:
+    """
+    Procesa varios .eml en paralelo. Son hilos y no procesos: casi todo el
+    tiempo se va esperando a Gemini por red.
+    
+    Returns:
+        True si todos se procesaron correctamente
+    """
+    def run(eml_path: Path) -> bool:
+        try:
+            return process_eml(str(eml_path))
+        except Exception as e:
+            log(f"❌ Error en {eml_path.name}: {e}")
+            return False
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, paths))
+    
+    log("📊 Resumen batch:")
+    for eml_path, success in zip(paths, results):
+        log(f"   {'✅' if success else '❌'} {eml_path.name}")
+    log(f"   {sum(results)}/{len(paths)} procesados correctamente")
+    
+    return all(results)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Procesa un .eml de estado de cuenta')
-    parser.add_argument('eml_file', help='Archivo .eml a procesar')
+    parser.add_argument('eml_file', nargs='?', help='Archivo .eml a procesar')
     parser.add_argument('--message-id', help='ID del mensaje en Mail para mark+move')
+    parser.add_argument('--batch', help='Carpeta o glob con .eml a procesar en paralelo')
+    parser.add_argument('--workers', type=int, default=8, help='Hilos en modo batch (default: 8)')
     
     args = parser.parse_args()
     
+    if args.batch:
+        batch = Path(args.batch).expanduser()
+        if batch.is_dir():
+            paths = sorted(batch.glob('*.eml'))
+        else:
+            paths = sorted(Path(batch.anchor or '.').glob(str(batch.relative_to(batch.anchor))))
+        
+        if not paths:
+            log(f"❌ No se encontraron .eml en '{args.batch}'")
+            sys.exit(1)
+        
+        log(f"📦 Procesando {len(paths)} .eml con {args.workers} hilo(s)")
+        sys.exit(0 if process_eml_batch(paths, args.workers) else 1)
+    
+    if not args.eml_file:
+        parser.error("falta el archivo .eml (o usa --batch)")
+    
     eml_path = Path(args.eml_file)
     
     if not eml_path.exists():
@@ -256,7 +358,6 @@ def main():
         
     except Exception as e:
         log(f"❌ Error fatal: {e}")
-        import traceback
         traceback.print_exc()
         sys.exit(1)
 
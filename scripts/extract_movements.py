@@ -13,17 +13,23 @@ Genera:
     - Renombra el PDF original al mismo formato
 """
 
+import os
+import re
+import glob
 import sys
-import csv
-import json
 import shutil
+import time
+import hashlib
+import itertools
+import tempfile
+import functools
+import importlib.util
 from pathlib import Path
 from typing import List, Optional
-from datetime import datetime
 
 from google import genai
 from google.genai import types
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -37,6 +43,7 @@ import logging
 
 # Importar configuración
 from config import GEMINI_API_KEY, OUTPUT_FOLDER
+from csv_append import CsvAppender
 
 # Logger para reintentos
 logger = logging.getLogger(__name__)
@@ -100,6 +107,72 @@ network_retry = retry(
 )
 
 
+# PDFs hasta este tamaño van inline en el request (límite de 20 MB por request,
+# con margen para el overhead de base64)
+INLINE_PDF_LIMIT = 14 * 1024 * 1024
+
+# Cache de respuestas de Gemini, indexado por hash del PDF + prompt
+GEMINI_CACHE_DIR = OUTPUT_FOLDER / ".gemini_cache"
+GEMINI_CACHE_MAX_ENTRIES = 200
+
+
+def _cache_key(pdf_path: str, prompt: str) -> str:
+    """SHA-256 del PDF (leído en streaming) y del prompt"""
+    with open(pdf_path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256')
+    digest.update(prompt.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _cache_get(key: str) -> str | None:
+    """Devuelve la respuesta cacheada (y la marca como usada), o None"""
+    cache_file = GEMINI_CACHE_DIR / f"{key}.json"
+    try:
+        text = cache_file.read_text(encoding='utf-8')
+        os.utime(cache_file)
+        return text
+    except OSError:
+        return None
+
+
+def _cache_discard(key: str):
+    """Elimina una entrada del cache"""
+    (GEMINI_CACHE_DIR / f"{key}.json").unlink(missing_ok=True)
+
+
+def _cache_put(key: str, text: str):
+    """Guarda una respuesta y elimina las entradas menos usadas"""
+    try:
+        GEMINI_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        
+        # Escritura atómica: otro proceso puede estar leyendo el cache
+        # (nombre único por escritura: dos hilos del batch pueden guardar la misma clave)
+        cache_file = GEMINI_CACHE_DIR / f"{key}.json"
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=GEMINI_CACHE_DIR,
+                                         suffix='.tmp', delete=False) as tmp:
+            tmp.write(text)
+        os.replace(tmp.name, cache_file)
+        
+        # LRU por mtime
+        entries = sorted(GEMINI_CACHE_DIR.glob('*.json'), key=lambda p: p.stat().st_mtime)
+        for old in entries[:-GEMINI_CACHE_MAX_ENTRIES]:
+            old.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"⚠️  No se pudo guardar en cache: {e}")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> genai.Client:
+    """Cliente de Gemini reutilizado entre estados de cuenta del mismo proceso"""
+    # HTTP/2 + keep-alive: upload y generate comparten la conexión TLS
+    # httpx exige el paquete h2 para HTTP/2; sin él se queda en HTTP/1.1
+    http_options = types.HttpOptions(client_args={
+        'http2': importlib.util.find_spec('h2') is not None,
+        'limits': httpx.Limits(max_keepalive_connections=4, max_connections=4),
+    })
+    return genai.Client(api_key=GEMINI_API_KEY, http_options=http_options)
+
+
 @network_retry
 def _upload_file(client: genai.Client, pdf_path: str):
     """Sube un archivo a Gemini con reintentos automáticos"""
@@ -107,11 +180,11 @@ def _upload_file(client: genai.Client, pdf_path: str):
 
 
 @network_retry
-def _generate_content(client: genai.Client, prompt: str, uploaded_file, schema):
+def _generate_content(client: genai.Client, prompt: str, document, schema):
     """Genera contenido con Gemini con reintentos automáticos"""
     return client.models.generate_content(
         model='gemini-2.5-flash',
-        contents=[prompt, uploaded_file],
+        contents=[prompt, document],
         config=types.GenerateContentConfig(
             response_mime_type='application/json',
             response_schema=schema,
@@ -125,13 +198,6 @@ def extract_statement(pdf_path: str) -> ExtractedStatement:
     Extrae metadatos y movimientos de un PDF de estado de cuenta
     """
     
-    client = genai.Client(api_key=GEMINI_API_KEY)
-    
-    # Subir PDF (con reintentos automáticos)
-    print(f"📄 Subiendo: {pdf_path}")
-    uploaded_file = _upload_file(client, pdf_path)
-    print(f"✅ Archivo subido: {uploaded_file.name}")
-    
     # Prompt mejorado
     prompt = """
 Analiza este documento y determina si es un estado de cuenta de tarjeta de crédito.
@@ -178,17 +244,47 @@ Extrae CADA LÍNEA de movimiento que encuentres:
 - Responde ÚNICAMENTE con el JSON estructurado
 """
     
+    # Si ya procesamos este mismo PDF, reutilizar la respuesta
+    cache_key = _cache_key(pdf_path, prompt)
+    response_text = _cache_get(cache_key)
+    
+    if response_text is not None:
+        try:
+            statement = ExtractedStatement.model_validate_json(response_text)
+            print("♻️  Respuesta tomada del cache")
+            return statement
+        except ValidationError:
+            # Entrada corrupta: se descarta y se vuelve a pedir a Gemini
+            print("⚠️  Entrada de cache inválida, se descarta")
+            _cache_discard(cache_key)
+    
+    client = _get_client()
+    
+    # PDFs chicos van inline en el request: se ahorra el round trip del upload
+    if Path(pdf_path).stat().st_size <= INLINE_PDF_LIMIT:
+        document = types.Part.from_bytes(
+            data=Path(pdf_path).read_bytes(),
+            mime_type='application/pdf',
+        )
+    else:
+        # Subir PDF (con reintentos automáticos)
+        print(f"📄 Subiendo: {pdf_path}")
+        document = _upload_file(client, pdf_path)
+        print(f"✅ Archivo subido: {document.name}")
+    
     print("🤖 Procesando con Gemini Flash 2.5...")
     
     # Llamada a Gemini con reintentos automáticos para errores de red
-    response = _generate_content(client, prompt, uploaded_file, ExtractedStatement)
+    response = _generate_content(client, prompt, document, ExtractedStatement)
+    response_text = response.text
     
     print("✅ Respuesta recibida")
     
-    # Parsear respuesta
-    data = json.loads(response.text)
-    statement = ExtractedStatement(**data)
+    # Parsear y validar en una sola pasada (pydantic-core)
+    statement = ExtractedStatement.model_validate_json(response_text)
     
+    # Solo se cachean respuestas válidas: una truncada se vuelve a pedir
+    _cache_put(cache_key, response_text)
     return statement
 
 
@@ -196,52 +292,43 @@ Extrae CADA LÍNEA de movimiento que encuentres:
 # EXPORTAR CSV POR MONEDA
 # ============================================================================
 
-def export_csv_by_currency(movements: List[Movement], output_path: str, moneda: str):
-    """Exporta movimientos de una moneda específica a CSV"""
-    
-    filtered = [m for m in movements if m.moneda == moneda]
+CSV_FIELDS = ('fecha', 'descripcion', 'monto', 'tipo')
+
+
+def partition_by_currency(movements: List[Movement]) -> dict[str, list[tuple]]:
+    """Separa los movimientos en filas CSV por moneda, en una sola pasada"""
+    by_currency = {'PEN': [], 'USD': []}
+    for m in movements:
+        rows = by_currency.get(m.moneda)
+        if rows is not None:
+            rows.append((m.fecha, m.descripcion, m.monto, m.tipo))
+    return by_currency
+
+
+def export_csv_by_currency(rows: list[tuple], output_path: str) -> bool:
+    """Exporta las filas de una moneda a CSV"""
     
-    if not filtered:
+    if not rows:
         return False
     
-    # Si el archivo es nuevo, escribir BOM UTF-8 para Excel
-    file_exists = Path(output_path).exists()
-    if not file_exists:
-        with open(output_path, 'wb') as f:
-            f.write(b'\xef\xbb\xbf')  # UTF-8 BOM
-    
-    with open(output_path, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=[
-            'fecha',
-            'descripcion',
-            'monto',
-            'tipo'
-        ])
-        
-        if not file_exists:
-            writer.writeheader()
-        
-        for mov in filtered:
-            writer.writerow({
-                'fecha': mov.fecha,
-                'descripcion': mov.descripcion,
-                'monto': mov.monto,
-                'tipo': mov.tipo
-            })
-    
-    print(f"✅ CSV generado: {output_path} ({len(filtered)} movimientos)")
+    with CsvAppender(output_path, CSV_FIELDS) as writer:
+        writer.writerows(rows)
+    
+    print(f"✅ CSV generado: {output_path} ({len(rows)} movimientos)")
     return True
 
 
+_FECHA_RE = re.compile(r'\d{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12]\d|3[01])')
+
+
 def generate_base_name(metadata: StatementMetadata) -> str:
     """Genera el nombre base para los archivos: 'Visa Interbank 2025-05'"""
     
-    # Extraer año-mes de la fecha de cierre
-    try:
-        fecha = datetime.strptime(metadata.fecha_cierre, '%Y-%m-%d')
-        year_month = fecha.strftime('%Y-%m')
-    except ValueError as e:
-        print(f"⚠️  Fecha de cierre malformada '{metadata.fecha_cierre}': {e}")
+    # Extraer año-mes de la fecha de cierre (ya viene como YYYY-MM-DD)
+    if _FECHA_RE.fullmatch(metadata.fecha_cierre):
+        year_month = metadata.fecha_cierre[:7]
+    else:
+        print(f"⚠️  Fecha de cierre malformada '{metadata.fecha_cierre}'")
         year_month = metadata.fecha_cierre[:7] if len(metadata.fecha_cierre) >= 7 else "0000-00"
     
     # Limpiar nombres
@@ -258,13 +345,13 @@ def print_summary(statement: ExtractedStatement):
     movs = statement.movimientos
     total_movs = len(movs)
     
-    # Separar por moneda
-    pen_movs = [m for m in movs if m.moneda == 'PEN']
-    usd_movs = [m for m in movs if m.moneda == 'USD']
-    
-    # Calcular totales (consumos positivos, pagos negativos)
-    pen_total = sum(m.monto for m in pen_movs)
-    usd_total = sum(m.monto for m in usd_movs)
+    # Contar por moneda en una sola pasada
+    pen_movs = usd_movs = 0
+    for m in movs:
+        if m.moneda == 'PEN':
+            pen_movs += 1
+        elif m.moneda == 'USD':
+            usd_movs += 1
     
     print("\n" + "="*60)
     print("📊 RESUMEN DE EXTRACCIÓN")
@@ -282,7 +369,7 @@ def print_summary(statement: ExtractedStatement):
         if meta.saldo_cierre_pen is not None:
             print(f"   Saldo cierre:   S/ {meta.saldo_cierre_pen:.2f}")
         if pen_movs:
-            print(f"   Movimientos: {len(pen_movs)}")
+            print(f"   Movimientos: {pen_movs}")
     
     if usd_movs or meta.saldo_cierre_usd is not None:
         print(f"\n💵 Dólares (USD):")
@@ -291,7 +378,7 @@ def print_summary(statement: ExtractedStatement):
         if meta.saldo_cierre_usd is not None:
             print(f"   Saldo cierre:   $ {meta.saldo_cierre_usd:.2f}")
         if usd_movs:
-            print(f"   Movimientos: {len(usd_movs)}")
+            print(f"   Movimientos: {usd_movs}")
     
     print("="*60 + "\n")
 
@@ -300,6 +387,31 @@ def print_summary(statement: ExtractedStatement):
 # MAIN
 # ============================================================================
 
+def _file_sha256(path) -> str:
+    """SHA-256 de un archivo, leído en streaming"""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def _find_identical_pdf(pdf_path, output_dir: Path, base_name: str) -> Optional[Path]:
+    """Busca entre los PDFs ya guardados con este nombre base uno con el mismo contenido"""
+    size = Path(pdf_path).stat().st_size
+    digest = None
+    candidates = [output_dir / f"{base_name}.pdf",
+                  *output_dir.glob(f"{glob.escape(base_name)} *.pdf")]
+    for candidate in candidates:
+        try:
+            # Solo se hashea si el tamaño coincide (y nunca el PDF contra sí mismo)
+            if candidate.stat().st_size != size or candidate.samefile(pdf_path):
+                continue
+        except OSError:
+            continue
+        digest = digest or _file_sha256(pdf_path)
+        if _file_sha256(candidate) == digest:
+            return candidate
+    return None
+
+
 def process_pdf(pdf_path: str, output_dir: Path = None) -> tuple[bool, ExtractedStatement | None]:
     """
     Procesa un PDF de estado de cuenta.
@@ -329,37 +441,40 @@ def process_pdf(pdf_path: str, output_dir: Path = None) -> tuple[bool, Extracted
     print(f"📁 Nombre base: {base_name}")
     
     # Exportar CSVs separados por moneda
-    pen_csv = output_dir / f"{base_name} PEN.csv"
-    usd_csv = output_dir / f"{base_name} USD.csv"
-    
-    pen_exported = export_csv_by_currency(statement.movimientos, str(pen_csv), 'PEN')
-    usd_exported = export_csv_by_currency(statement.movimientos, str(usd_csv), 'USD')
-    
-    if not pen_exported:
-        print("ℹ️  Sin movimientos en PEN")
-    if not usd_exported:
-        print("ℹ️  Sin movimientos en USD")
+    for moneda, rows in partition_by_currency(statement.movimientos).items():
+        csv_path = output_dir / f"{base_name} {moneda}.csv"
+        if not export_csv_by_currency(rows, str(csv_path)):
+            print(f"ℹ️  Sin movimientos en {moneda}")
     
     # Exportar JSON completo
     json_path = output_dir / f"{base_name}.json"
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(
-            {
-                'metadata': statement.metadata.model_dump(),
-                'movimientos': [m.model_dump() for m in statement.movimientos]
-            },
-            f,
-            indent=2,
-            ensure_ascii=False
-        )
+    json_path.write_text(statement.model_dump_json(indent=2), encoding='utf-8')
     print(f"💾 JSON generado: {json_path}")
     
     # Renombrar PDF original
     new_pdf_name = output_dir / f"{base_name}.pdf"
     if pdf_path != new_pdf_name:
-        if new_pdf_name.exists():
+        duplicate = _find_identical_pdf(pdf_path, output_dir, base_name)
+        if duplicate is not None:
+            # Re-proceso del mismo correo: no se acumulan copias idénticas
+            Path(pdf_path).unlink()
+            print(f"📄 PDF idéntico ya guardado: {duplicate}")
+        elif new_pdf_name.exists():
+            # El PDF puede venir de un directorio temporal: se guarda con otro nombre
+            # en vez de dejarlo donde se va a borrar. El contador evita pisar otro
+            # duplicado procesado en el mismo segundo por un hilo del batch
+            stamp = time.strftime('%Y%m%d-%H%M%S')
+            fallback_name = output_dir / f"{base_name} {stamp}.pdf"
+            for n in itertools.count(2):
+                try:
+                    # Reservar el nombre de forma atómica antes de mover
+                    fallback_name.touch(exist_ok=False)
+                    break
+                except FileExistsError:
+                    fallback_name = output_dir / f"{base_name} {stamp} {n}.pdf"
+            shutil.move(str(pdf_path), str(fallback_name))
             print(f"⚠️  PDF destino ya existe: {new_pdf_name}")
-            print(f"    PDF original conservado en: {pdf_path}")
+            print(f"    PDF guardado como: {fallback_name}")
         else:
             shutil.move(str(pdf_path), str(new_pdf_name))
             print(f"📄 PDF renombrado: {new_pdf_name}")
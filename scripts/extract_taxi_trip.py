@@ -9,25 +9,33 @@ Los datos se agregan a un CSV consolidado.
 
 Uso:
     python extract_taxi_trip.py <archivo.eml> [--message-id ID]
+    python extract_taxi_trip.py --batch <carpeta> [--parallel]
 
 El --message-id es opcional y se usa para marcar como leído y mover el mensaje
 en Mail.app después de un procesamiento exitoso.
+
+Con --batch se agrupan hasta BATCH_SIZE correos por request a Gemini (o, con
+--parallel, un request por correo en paralelo); los archivos no se eliminan.
 """
 
+import re
 import sys
-import csv
-import json
 import email
+import functools
+import importlib.util
 from email import policy
+import logging
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
+import httpx
 from google import genai
 from google.genai import types
-from pydantic import BaseModel, Field
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+from pydantic import BaseModel, Field, TypeAdapter
+import lxml.html
+from lxml import etree
 
 # Importar configuración
 from config import (
@@ -38,6 +46,8 @@ from config import (
     ensure_folders
 )
 from mail_actions import mark_read_and_move
+# CSV en append con flock: la regla de Mail lanza varios procesos a la vez
+from csv_append import CsvAppender
 
 
 # ============================================================================
@@ -62,36 +72,56 @@ def log(msg: str):
     print(f"[{ts}] {msg}")
 
 
+# Log de errores: un solo handle abierto (al primer error) para todo el proceso
+_error_logger = logging.getLogger('taxi.err')
+_error_logger.propagate = False
+_error_handler = logging.FileHandler(TAXI_ERROR_LOG, encoding='utf-8', delay=True)
+_error_handler.setFormatter(logging.Formatter(f"\n{'='*60}\n[%(asctime)s] %(message)s"))
+_error_logger.addHandler(_error_handler)
+
+
 # ============================================================================
 # PROCESAMIENTO
 # ============================================================================
 
+_HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+# Elementos tras los cuales se corta la línea al extraer el texto
+_BLOCK_TAGS = ('p', 'div', 'br', 'tr', 'td', 'th', 'li', 'h1', 'h2', 'h3', 'h4', 'table')
+
+# Marcas de estructura que se mantienen (Gemini no necesita Markdown completo)
+_MARKERS = {'h1': '# ', 'h2': '## ', 'h3': '### ', 'h4': '#### ', 'li': '- '}
+
+# Espacios dentro de una línea / espacios alrededor de saltos (incluye líneas vacías)
+_SPACES = re.compile(r'[^\S\n]+')
+_BLANK_LINES = re.compile(r'\s*\n\s*')
+
+
 def html_to_markdown(html_content: str) -> str:
-    """Convierte HTML a Markdown limpio"""
+    """Extrae el texto visible del HTML, una línea por bloque, con # y - para
+    títulos e items de lista"""
     
-    # Limpiar con BeautifulSoup
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Eliminar scripts, styles, etc.
-    for tag in soup(['script', 'style', 'meta', 'link', 'head']):
-        tag.decompose()
+    try:
+        tree = lxml.html.document_fromstring(html_content.encode('utf-8'), parser=_HTML_PARSER)
+    except etree.ParserError:
+        # HTML vacío (o solo comentarios)
+        return ''
     
-    # Convertir a markdown
-    markdown = md(str(soup), heading_style="ATX", strip=['img'])
+    etree.strip_elements(tree, 'script', 'style', 'meta', 'link', 'head', with_tail=False)
     
-    # Limpiar líneas vacías excesivas
-    lines = [line.strip() for line in markdown.split('\n')]
-    cleaned = '\n'.join(line for line in lines if line)
+    # Evita que celdas/párrafos contiguos se peguen ("TotalS/ 12.50")
+    for element in tree.iter(*_BLOCK_TAGS):
+        marker = _MARKERS.get(element.tag)
+        if marker:
+            element.text = '\n' + marker + (element.text or '')
+        element.tail = '\n' + (element.tail or '')
     
-    return cleaned
+    text = _SPACES.sub(' ', tree.text_content())
+    return _BLANK_LINES.sub('\n', text).strip()
 
 
-def extract_trip_info(markdown_content: str) -> TaxiTrip:
-    """Usa Gemini para extraer información del viaje"""
-    
-    client = genai.Client(api_key=GEMINI_API_KEY)
-    
-    prompt = """
+# Prompt compartido por el modo individual y el batch
+PROMPT = """
 Analiza este correo de un servicio de taxi/transporte (Uber, Cabify, Beat, InDriver, DiDi, etc.)
 y extrae la información del viaje.
 
@@ -116,12 +146,59 @@ y extrae la información del viaje.
 
 CONTENIDO DEL CORREO:
 """
+
+# Máximo de correos por request en modo batch (contexto del modelo)
+BATCH_SIZE = 20
+
+# Máximo de requests simultáneos a Gemini cuando se extrae de a un correo
+MAX_CONCURRENT_REQUESTS = 8
+
+# Parseo + validación de la lista de viajes del batch en una sola pasada
+_TRIPS_ADAPTER = TypeAdapter(list[TaxiTrip])
+
+BATCH_INSTRUCTIONS = """
+El contenido incluye {count} correos distintos, separados por "--- EMAIL i ---".
+Devuelve una lista con exactamente un objeto por correo, en el mismo orden.
+"""
+
+
+# Los datos del recibo están al principio; el resto (footer, legales, links de
+# baja) solo suma tokens
+MAX_MD_CHARS = 8000
+_SEPARATORS = re.compile(r'([=\-_*~])\1{3,}')
+
+
+def trim_for_prompt(markdown: str) -> str:
+    """Colapsa separadores (====, ----) y recorta a MAX_MD_CHARS"""
+    markdown = _SEPARATORS.sub(r'\1\1\1', markdown)
+    if len(markdown) > MAX_MD_CHARS:
+        log(f"✂️  Contenido recortado de {len(markdown)} a {MAX_MD_CHARS} caracteres")
+        markdown = markdown[:MAX_MD_CHARS]
+    return markdown
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> genai.Client:
+    """Cliente de Gemini reutilizado entre correos del mismo proceso"""
+    # HTTP/2 + keep-alive: los requests siguientes reutilizan la conexión TLS
+    # httpx exige el paquete h2 para HTTP/2; sin él se queda en HTTP/1.1
+    http_options = types.HttpOptions(client_args={
+        'http2': importlib.util.find_spec('h2') is not None,
+        'limits': httpx.Limits(max_keepalive_connections=4, max_connections=4),
+    })
+    return genai.Client(api_key=GEMINI_API_KEY, http_options=http_options)
+
+
+def extract_trip_info(markdown_content: str) -> TaxiTrip:
+    """Usa Gemini para extraer información del viaje"""
+    
+    client = _get_client()
     
     log("🤖 Extrayendo información con Gemini...")
     
     response = client.models.generate_content(
         model='gemini-2.5-flash',
-        contents=[prompt + "\n\n" + markdown_content],
+        contents=[PROMPT + "\n\n" + trim_for_prompt(markdown_content)],
         config=types.GenerateContentConfig(
             response_mime_type='application/json',
             response_schema=TaxiTrip,
@@ -129,42 +206,145 @@ CONTENIDO DEL CORREO:
         ),
     )
     
-    data = json.loads(response.text)
-    trip = TaxiTrip(**data)
+    # Parsear y validar en una sola pasada (pydantic-core)
+    return TaxiTrip.model_validate_json(response.text)
+
+
+def extract_trips_batch(markdowns: list[str]) -> list[TaxiTrip]:
+    """Extrae los viajes de varios correos en un solo request a Gemini"""
+    
+    client = _get_client()
+    
+    body = "".join(
+        f"\n\n--- EMAIL {i} ---\n{trim_for_prompt(markdown)}"
+        for i, markdown in enumerate(markdowns, start=1)
+    )
+    
+    log(f"🤖 Extrayendo {len(markdowns)} correo(s) con Gemini...")
+    
+    response = client.models.generate_content(
+        model='gemini-2.5-flash',
+        contents=[PROMPT + BATCH_INSTRUCTIONS.format(count=len(markdowns)) + body],
+        config=types.GenerateContentConfig(
+            response_mime_type='application/json',
+            response_schema=list[TaxiTrip],
+            temperature=0.1,
+        ),
+    )
+    
+    trips = _TRIPS_ADAPTER.validate_json(response.text)
+    if len(trips) != len(markdowns):
+        raise ValueError(f"Gemini devolvió {len(trips)} viajes para {len(markdowns)} correos")
     
-    return trip
+    return trips
+
+
+CSV_FIELDS = ('fecha', 'hora', 'empresa', 'origen', 'destino', 'moneda', 'precio')
+
+
+def trip_row(trip: TaxiTrip) -> tuple:
+    """Fila CSV del viaje, en el mismo orden que CSV_FIELDS"""
+    return (
+        trip.fecha, trip.hora, trip.empresa, trip.origen,
+        trip.destino, trip.moneda, trip.precio
+    )
 
 
 def append_to_csv(trip: TaxiTrip):
     """Agrega el viaje al CSV consolidado"""
     
-    csv_path = TAXI_CSV
-    file_exists = csv_path.exists()
+    with CsvAppender(TAXI_CSV, CSV_FIELDS) as writer:
+        writer.writerow(trip_row(trip))
     
-    # Crear archivo con BOM si es nuevo
-    if not file_exists:
-        with open(csv_path, 'wb') as f:
-            f.write(b'\xef\xbb\xbf')  # UTF-8 BOM para Excel
+    log(f"✅ Viaje agregado a: {TAXI_CSV}")
+
+
+# Un recibo menciona el viaje/total o trae un monto con moneda (antes o después
+# del número: "S/ 15.30", "15.30 soles"). Si en los primeros caracteres no hay
+# ni lo uno ni lo otro, el correo es publicidad/encuesta y no se envía a Gemini.
+_RECEIPT_KEYWORD_RE = re.compile(r'(?i)\b(total|precio|tarifa|fare|receipt|recibo|viaje|trip)\b')
+_AMOUNT_RE = re.compile(
+    r'(?i)(?:S/\.?|\bPEN\b|\bUSD\b|\$)\s*\d'
+    r'|\d\s*(?:soles|PEN|USD|d[oó]lares)\b'
+)
+RECEIPT_SCAN_CHARS = 20000
+
+
+def looks_like_receipt(markdown: str) -> bool:
+    """Prefiltro local: ¿el contenido parece un recibo de viaje?"""
+    head = markdown[:RECEIPT_SCAN_CHARS]
+    return _RECEIPT_KEYWORD_RE.search(head) is not None or _AMOUNT_RE.search(head) is not None
+
+
+def read_eml_markdown(eml_path: Path) -> str | None:
+    """Extrae el contenido del correo (HTML convertido a Markdown, o texto)"""
     
-    with open(csv_path, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=[
-            'fecha', 'hora', 'empresa', 'origen', 'destino', 'moneda', 'precio'
-        ])
-        
-        if not file_exists:
-            writer.writeheader()
-        
-        writer.writerow({
-            'fecha': trip.fecha,
-            'hora': trip.hora,
-            'empresa': trip.empresa,
-            'origen': trip.origen,
-            'destino': trip.destino,
-            'moneda': trip.moneda,
-            'precio': trip.precio
-        })
+    # Leer correo
+    with open(eml_path, 'rb') as f:
+        msg = email.message_from_binary_file(f, policy=policy.default)
+    
+    # Preferir HTML, sino texto; get_content() ya decodifica con el charset declarado
+    body = msg.get_body(preferencelist=('html', 'plain'))
+    if body is None:
+        return None
+    
+    if body.get_param('charset') is None:
+        # Sin charset declarado get_content() decodifica como ASCII y rompe los
+        # acentos; estos correos vienen en UTF-8
+        content = body.get_payload(decode=True).decode('utf-8', errors='replace')
+    else:
+        content = body.get_content()
+    
+    if body.get_content_type() == 'text/html':
+        return html_to_markdown(content)
+    return content
+
+
+def record_trip(trip: TaxiTrip, message_id: str = None) -> bool:
+    """Agrega el viaje al CSV y, si hay message_id, lo mueve en Mail"""
+    
+    if not trip.es_viaje:
+        log("⚠️  El correo NO es un recibo de viaje (publicidad u otro)")
+        return False
+    
+    log(f"🚗 {trip.empresa}: {trip.origen} → {trip.destino}")
+    log(f"📅 {trip.fecha} {trip.hora} - {trip.moneda} {trip.precio}")
+    
+    # Agregar al CSV
+    append_to_csv(trip)
+    
+    # Marcar y mover en Mail si tenemos message_id
+    if message_id:
+        move_message(message_id)
+    
+    return True
+
+
+def move_message(message_id: str):
+    """Marca como leído y mueve el mensaje a la carpeta de taxis en Mail"""
+    log(f"📬 Moviendo mensaje {message_id} a {TAXI_FOLDER}...")
+    if mark_read_and_move(message_id, TAXI_FOLDER):
+        log("✅ Mensaje movido exitosamente")
+    else:
+        log("⚠️  No se pudo mover el mensaje (pero el viaje se registró)")
+
+
+def record_error(eml_path: Path, error: Exception):
+    """Registra un error de extracción en el log de errores"""
     
-    log(f"✅ Viaje agregado a: {csv_path}")
+    log(f"❌ Error extrayendo información: {error}")
+    
+    # Guardar error (con el traceback de la excepción, aunque venga de otro hilo)
+    _error_logger.error("Error procesando %s\n%s", eml_path.name, error, exc_info=error)
+
+
+def record_skip(eml_path: Path):
+    """Registra un correo descartado por el prefiltro (sin llamar a Gemini)"""
+    
+    log(f"⚠️  Prefiltro: {eml_path.name} NO parece un recibo de viaje, se omite Gemini")
+    
+    # Queda en el log de errores para poder revisar falsos negativos
+    _error_logger.warning("Prefiltro: %s omitido (no parece un recibo de viaje)", eml_path.name)
 
 
 def process_eml(eml_path: str, message_id: str = None) -> bool:
@@ -177,87 +357,157 @@ def process_eml(eml_path: str, message_id: str = None) -> bool:
     5. Si tiene message_id, marca leído y mueve en Mail
     """
     
+    # Cacheado en config: solo el primer correo del proceso crea las carpetas
     ensure_folders()
     eml_path = Path(eml_path)
     
     log(f"📧 Procesando: {eml_path.name}")
     
-    # Leer correo
-    with open(eml_path, 'rb') as f:
-        msg = email.message_from_binary_file(f, policy=policy.default)
-    
-    # Obtener contenido HTML o texto
-    html_content = None
-    text_content = None
-    
-    for part in msg.walk():
-        content_type = part.get_content_type()
-        
-        if content_type == 'text/html':
-            payload = part.get_payload(decode=True)
-            charset = part.get_content_charset() or 'utf-8'
-            html_content = payload.decode(charset, errors='replace')
-        elif content_type == 'text/plain' and not html_content:
-            payload = part.get_payload(decode=True)
-            charset = part.get_content_charset() or 'utf-8'
-            text_content = payload.decode(charset, errors='replace')
-    
-    # Preferir HTML, sino texto
-    if html_content:
-        markdown = html_to_markdown(html_content)
-    elif text_content:
-        markdown = text_content
-    else:
+    markdown = read_eml_markdown(eml_path)
+    if not markdown:
         log("❌ No se encontró contenido en el correo")
         return False
     
     log(f"📝 Contenido extraído: {len(markdown)} caracteres")
     
+    if not looks_like_receipt(markdown):
+        record_skip(eml_path)
+        return False
+    
     # Extraer información
     try:
         trip = extract_trip_info(markdown)
+        return record_trip(trip, message_id)
+        
+    except Exception as e:
+        record_error(eml_path, e)
+        return False
+
+
+def extract_trips_parallel(markdowns: list[str]) -> list[TaxiTrip | Exception]:
+    """
+    Extrae los viajes con un request por correo, en paralelo. Cada resultado
+    es el viaje o la excepción de ese correo, en el mismo orden.
+    """
+    
+    def run(markdown: str) -> TaxiTrip | Exception:
+        try:
+            return extract_trip_info(markdown)
+        except Exception as e:
+            return e
+    
+    # Hilos: cada request pasa casi todo el tiempo esperando a Gemini
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as pool:
+        return list(pool.map(run, markdowns))
+
+
+def process_eml_batch(eml_paths: list[Path], message_ids: list[str | None] = None,
+                      grouped: bool = True) -> int:
+    """
+    Procesa varios .eml. Con grouped=True se hace un request a Gemini por cada
+    BATCH_SIZE correos; si no (o si un batch falla), un request por correo,
+    en paralelo. El CSV y Mail se actualizan después, de a un viaje.
+    
+    Returns:
+        Cantidad de viajes registrados
+    """
+    
+    ensure_folders()
+    if message_ids is None:
+        message_ids = [None] * len(eml_paths)
+    
+    # Leer todos los correos (rápido, sin red)
+    pending = []
+    for eml_path, message_id in zip(eml_paths, message_ids):
+        log(f"📧 Leyendo: {eml_path.name}")
+        try:
+            markdown = read_eml_markdown(eml_path)
+        except Exception as e:
+            record_error(eml_path, e)
+            continue
         
-        if not trip.es_viaje:
-            log("⚠️  El correo NO es un recibo de viaje (publicidad u otro)")
-            return False
+        if not markdown:
+            log(f"❌ No se encontró contenido en {eml_path.name}")
+            continue
         
-        log(f"🚗 {trip.empresa}: {trip.origen} → {trip.destino}")
-        log(f"📅 {trip.fecha} {trip.hora} - {trip.moneda} {trip.precio}")
+        if not looks_like_receipt(markdown):
+            record_skip(eml_path)
+            continue
         
-        # Agregar al CSV
-        append_to_csv(trip)
+        pending.append((eml_path, message_id, markdown))
+    
+    recorded = 0
+    for i in range(0, len(pending), BATCH_SIZE):
+        chunk = pending[i:i + BATCH_SIZE]
         
-        # Marcar y mover en Mail si tenemos message_id
-        if message_id:
-            log(f"📬 Moviendo mensaje {message_id} a {TAXI_FOLDER}...")
-            if mark_read_and_move(message_id, TAXI_FOLDER):
-                log("✅ Mensaje movido exitosamente")
-            else:
-                log("⚠️  No se pudo mover el mensaje (pero el viaje se registró)")
+        markdowns = [markdown for _, _, markdown in chunk]
         
-        return True
+        trips = None
+        if grouped:
+            try:
+                trips = extract_trips_batch(markdowns)
+            except Exception as e:
+                log(f"⚠️  Batch falló ({e}), procesando individualmente")
         
-    except Exception as e:
-        log(f"❌ Error extrayendo información: {e}")
+        if trips is None:
+            trips = extract_trips_parallel(markdowns)
         
-        # Guardar error
-        with open(TAXI_ERROR_LOG, 'a') as f:
-            f.write(f"\n{'='*60}\n")
-            f.write(f"[{datetime.now()}] Error procesando {eml_path.name}\n")
-            f.write(f"{e}\n")
-            import traceback
-            f.write(traceback.format_exc())
+        rows = []
+        to_move = []
+        for (eml_path, message_id, _), trip in zip(chunk, trips):
+            log(f"📧 {eml_path.name}")
+            if isinstance(trip, Exception):
+                record_error(eml_path, trip)
+                continue
+            
+            if not trip.es_viaje:
+                log("⚠️  El correo NO es un recibo de viaje (publicidad u otro)")
+                continue
+            
+            log(f"🚗 {trip.empresa}: {trip.origen} → {trip.destino}")
+            log(f"📅 {trip.fecha} {trip.hora} - {trip.moneda} {trip.precio}")
+            rows.append(trip_row(trip))
+            if message_id:
+                to_move.append(message_id)
         
-        return False
+        # Todas las filas del bloque con un solo open del CSV (y ninguno si no hay
+        # viajes: no se crea un CSV con solo el header)
+        if rows:
+            with CsvAppender(TAXI_CSV, CSV_FIELDS) as writer:
+                writer.writerows(rows)
+            recorded += len(rows)
+        
+        # Mover en Mail recién con las filas ya escritas en disco
+        for message_id in to_move:
+            move_message(message_id)
+    
+    log(f"✅ {recorded} viaje(s) agregados a: {TAXI_CSV}")
+    return recorded
 
 
 def main():
     parser = argparse.ArgumentParser(description='Procesa un .eml de viaje de taxi')
-    parser.add_argument('eml_file', help='Archivo .eml a procesar')
+    parser.add_argument('eml_file', nargs='?', help='Archivo .eml a procesar')
     parser.add_argument('--message-id', help='ID del mensaje en Mail para mark+move')
+    parser.add_argument('--batch', help='Carpeta con .eml a procesar en batch')
+    parser.add_argument('--parallel', action='store_true',
+                        help='En batch, un request por correo en paralelo en vez de agruparlos')
     
     args = parser.parse_args()
     
+    if args.batch:
+        eml_paths = sorted(Path(args.batch).expanduser().glob('*.eml'))
+        if not eml_paths:
+            log(f"❌ No se encontraron .eml en '{args.batch}'")
+            sys.exit(1)
+        
+        recorded = process_eml_batch(eml_paths, grouped=not args.parallel)
+        log(f"✅ {recorded}/{len(eml_paths)} viaje(s) registrados")
+        sys.exit(0 if recorded == len(eml_paths) else 1)
+    
+    if not args.eml_file:
+        parser.error("falta el archivo .eml (o usa --batch)")
+    
     eml_path = Path(args.eml_file)
     
     if not eml_path.exists():